@@ -0,0 +1,579 @@
+"""
+Benchmarks for the map generation, rendering and fight hot paths in run.py.
+
+Run with:
+    python3 benchmark.py                    # run and print timings
+    python3 benchmark.py --save-baseline    # store timings as the baseline
+    python3 benchmark.py --baseline FILE    # compare with a stored baseline
+    python3 benchmark.py --check            # check the fast paths' results
+
+Results can be saved as JSON with --output. When compared with a baseline,
+the exit code is 1 if any benchmark got slower by more than --threshold.
+Baselines depend on the machine, so compare runs made on the same machine.
+
+--check doesn't time anything. It checks that the optimised code gives
+the same results as the code it replaced: maps are the same for a seed
+every time, batched and parallel smoothing match count_neighbours, the
+projectile backends play the same fight, pathfinding's distance fields
+match its routes, and saved games resume as they were. The exit code is
+1 if any check fails.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import run
+
+# Map sizes (height, width) the map benchmarks run at
+MAP_SIZES = [(75, 250), (150, 500), (300, 1000)]
+# Processes the parallel smoothing benchmarks use, at least 2 so they
+# measure the parallel path even on one CPU
+SMOOTH_WORKERS = max(run.SMOOTH_WORKERS, 2)
+# Live projectile counts for the fight tick benchmarks
+PROJECTILE_COUNTS = [10, 100, 1000, 10000]
+
+# --check: seeds, map sizes (height, width) and fight length checked
+CHECK_SEEDS = [0, 1, 2]
+CHECK_SIZES = [(1, 1), (7, 13), (40, 61)]
+CHECK_TICKS = 500
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_baseline.json")
+
+
+def random_map(height, width, seed=0):
+    """ Unsmoothed random map, as made by build_map """
+    return run.build_map(height, width, 0.35, random.Random(seed))
+
+
+def smoothed_map(height, width, seed=0):
+    """ Finished cave shaped map, without the bear """
+    return run.smooth_map(random_map(height, width, seed), 7)
+
+
+def time_call(func, setup=None, min_time=0.2, max_rounds=1000):
+    """
+    Times a function, calling it until min_time seconds were spent in it
+    (at least 3 times) or it was called max_rounds times
+    Args:
+        func (function): Function to time, called with setup()'s result
+        setup (function): Makes fresh arguments for each call, untimed
+        min_time (float): Seconds to spend timing
+        max_rounds (int): Most calls to make
+    Returns:
+        result (dict): Median and fastest time per call in seconds, and
+                       the number of calls timed
+    """
+    times = []
+    while len(times) < 3 or (sum(times) < min_time
+                             and len(times) < max_rounds):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times),
+            "rounds": len(times)}
+
+
+class Cases(dict):
+    """ Benchmark name: (function, setup) for the names a filter matches """
+    def __init__(self, pattern=None):
+        """
+        Args:
+            pattern (str): Only keep benchmarks with this in their name
+        """
+        super().__init__()
+        self.pattern = pattern
+
+    def wants(self, *names):
+        """
+        Checks if any of the names match the filter, so suites only do
+        the set up of benchmarks that will run
+        Args:
+            names (str): Benchmark names
+        Returns:
+            wanted (bool): Whether any of them match
+        """
+        return any(not self.pattern or self.pattern in name
+                   for name in names)
+
+    def add(self, name, func, setup=None):
+        """
+        Adds a benchmark if its name matches the filter
+        Args:
+            name (str): Benchmark name
+            func (function): Function to time, see time_call
+            setup (function): Makes fresh arguments for each call
+        """
+        if self.wants(name):
+            self[name] = (func, setup)
+
+
+def map_benchmarks(cases, stack):
+    """
+    build_map, smooth_map (serial and in SMOOTH_WORKERS processes),
+    count_neighbours and spawn_rock
+    Args:
+        cases (Cases): Benchmarks to add to
+        stack (contextlib.ExitStack): Cleans up after the suite ran
+    """
+    pool = None
+    for height, width in MAP_SIZES:
+        size = f"{height}x{width}"
+
+        cases.add(f"build_map[{size}]",
+                  lambda height=height, width=width: run.build_map(
+                      height, width, 0.35, random.Random(0)))
+
+        def fresh_map(height=height, width=width):
+            return (random_map(height, width),)
+
+        cases.add(f"smooth_map[{size}]",
+                  lambda map: run.smooth_map(map, 1), fresh_map)
+        cases.add(f"smooth_map_x7[{size}]",
+                  lambda map: run.smooth_map(map, 7), fresh_map)
+        if pool is None and cases.wants(f"smooth_map_x7_parallel[{size}]"):
+            # Started once, like run_map_pool does, so process start up
+            # isn't timed
+            pool = stack.enter_context(ProcessPoolExecutor(SMOOTH_WORKERS))
+        cases.add(f"smooth_map_x7_parallel[{size}]",
+                  lambda map: run.smooth_map_parallel(map, 7, SMOOTH_WORKERS,
+                                                      pool),
+                  fresh_map)
+
+        # count_neighbours for one tile in the middle of each 10x10 block
+        tiles = [(row, col) for row in range(5, height, 10)
+                 for col in range(5, width, 10)]
+        if not cases.wants(f"count_neighbours_x{len(tiles)}[{size}]",
+                           f"spawn_rock[{size}]"):
+            continue
+        map = smoothed_map(height, width)
+        cases.add(f"count_neighbours_x{len(tiles)}[{size}]",
+                  lambda map=map, tiles=tiles: [
+                      run.count_neighbours(map, row, col, 1)
+                      for row, col in tiles])
+
+        def finished_map(map=map):
+            return (run.TileGrid.from_tiles(map.tiles.copy()),
+                    random.Random(0))
+
+        cases.add(f"spawn_rock[{size}]",
+                  lambda map, rng: run.spawn_rock(map, rng=rng),
+                  finished_map)
+
+
+def draw_benchmarks(cases, stack):
+    """
+    draw_map and MapRenderer painting onto in-memory windows
+    Args:
+        cases (Cases): Benchmarks to add to
+        stack (contextlib.ExitStack): Cleans up after the suite ran
+    """
+    height, width = MAP_SIZES[0]
+    if not cases.wants(f"draw_map[{height}x{width}]", "paint_view[uncached]",
+                       "paint_view[cached]"):
+        return
+    colors = {name: 0 for name in
+              ("w_black", "black_w", "w_black_goldilocks", "w_black_rock",
+               "w_black_bear_adj", "w_black_goldilocks_adj")}
+    map = smoothed_map(height, width)
+    map = run.spawn_rock(map, rng=random.Random(0))
+    screen = run.HeadlessWindow(None, height, width + 2)
+    cases.add(f"draw_map[{height}x{width}]",
+              lambda: run.draw_map(screen, map, colors))
+
+    # MapRenderer painting the whole viewport, as it does at the start and
+    # when the quest starts, without and with its row runs cached
+    run.use_backend(run.HeadlessCurses([]))
+    stack.callback(run.use_backend, None)
+    view = run.Viewport(run.VIEW_ROWS, run.VIEW_COLS, run.VIEW_MARGIN)
+    view.move(10, 60)
+    renderer = run.MapRenderer(view, map, colors)
+    cases.add("paint_view[uncached]",
+              lambda: (renderer.runs.clear(), renderer.draw()))
+    cases.add("paint_view[cached]", renderer.draw)
+
+
+def fight_benchmarks(cases, stack):
+    """
+    One fight tick with N live projectiles, for each projectile backend:
+    the game's own Fight.tick (move Goldilocks and the projectiles, hit
+    tests for Goldilocks and the player) then Fight.draw. fight_update is
+    the same tick without drawing. Each round starts from a fresh fight
+    with N projectiles spread over the fight area, so the count is N
+    Args:
+        cases (Cases): Benchmarks to add to
+        stack (contextlib.ExitStack): Cleans up after the suite ran
+    """
+    for name, backend in run.PROJECTILE_BACKENDS.items():
+        for count in PROJECTILE_COUNTS:
+            def fresh_fight(backend=backend, count=count):
+                rng = random.Random(0)
+                projectiles = backend()
+                for ind in range(count):
+                    projectiles.spawn(rng.randrange(2, 16),
+                                      rng.randrange(1, 59),
+                                      rng.choice((1, -1)))
+                fight_win = run.HeadlessWindow(None, 18, 60)
+                return (run.Fight(fight_win, projectiles),)
+
+            def tick(fight):
+                fight.tick()
+                fight.draw(True)
+
+            cases.add(f"fight_tick[{name},{count}]", tick, fresh_fight)
+            cases.add(f"fight_update[{name},{count}]",
+                      lambda fight: fight.tick(), fresh_fight)
+
+
+SUITES = {
+    "map": map_benchmarks,
+    "draw": draw_benchmarks,
+    "fight": fight_benchmarks,
+}
+
+
+def run_benchmarks(pattern=None, min_time=0.2):
+    """
+    Runs every benchmark whose name contains pattern
+    Args:
+        pattern (str): Only run benchmarks with this in their name
+        min_time (float): Seconds to spend timing each benchmark
+    Returns:
+        results (dict): Benchmark name: timings, see time_call
+    """
+    results = {}
+    for suite in SUITES.values():
+        # Shuts the suite's process pool down and restores the curses
+        # backend before the next suite
+        with contextlib.ExitStack() as stack:
+            cases = Cases(pattern)
+            suite(cases, stack)
+            for name, (func, setup) in cases.items():
+                results[name] = time_call(func, setup, min_time)
+                print(f"{name:<40} "
+                      f"{results[name]['median'] * 1000:10.3f} ms")
+    return results
+
+
+def reference_smooth(map, iterations):
+    """
+    The original smoothing, one count_neighbours call per tile, that the
+    batched smooth_map must match
+    """
+    for ind in range(iterations):
+        tiles = [[1 if run.count_neighbours(map, row, col, 1) >= 4 else 0
+                  for col in range(map.width)] for row in range(map.height)]
+        map = run.TileGrid.from_tiles(np.array(tiles, dtype=np.uint8))
+    return map
+
+
+def rock_keys(map, rocks=3):
+    """
+    Keys that walk the player from the start to the nearest rocks, picking
+    them up, then show the inventory
+    Args:
+        map (TileGrid, MapOverlay or ChunkManager): Map the game is on
+        rocks (int): Number of rocks to pick up
+    Returns:
+        keys (list): Keys to press, see HeadlessCurses
+    """
+    moves = {(-1, 0): "w", (1, 0): "s", (0, -1): "a", (0, 1): "d"}
+    paths = run.PathFinder(map)
+    at = (24, 40)  # Where the player starts
+    keys = []
+    for ind in range(rocks):
+        routes = [paths.find_path(at, tuple(rock)) for rock in
+                  np.argwhere(np.array(map[0:run.ROWS, 0:run.COLS]) == 3)]
+        route = min((route for route in routes if route), key=len)
+        keys += [moves[(row - last_row, col - last_col)] for
+                 (last_row, last_col), (row, col) in zip(route, route[1:])]
+        at = route[-1]
+        map[at] = 0
+    return keys + ["i", "x"]
+
+
+def check_generate_map():
+    """ generate_map makes the same map and bear for a seed every time,
+    and the map cache gives it back unchanged """
+    failures = []
+    with tempfile.TemporaryDirectory() as folder:
+        for seed in CHECK_SEEDS:
+            first = run.generate_map(seed)
+            bear = (run.BEAR_Y, run.BEAR_X)
+            second = run.generate_map(seed)
+            if (not np.array_equal(first.tiles, second.tiles)
+                    or bear != (run.BEAR_Y, run.BEAR_X)):
+                failures.append(f"seed {seed}: map differs between calls")
+            path = os.path.join(folder, f"{seed}.map")
+            run.save_map(path, first)
+            loaded = run.load_map(path)
+            if (not isinstance(loaded, run.TileGrid)
+                    or not np.array_equal(loaded.tiles, first.tiles)
+                    or bear != (run.BEAR_Y, run.BEAR_X)):
+                failures.append(f"seed {seed}: cached map differs")
+    return failures
+
+
+def check_smooth_map():
+    """ smooth_map and NeighbourIndex agree with count_neighbours """
+    failures = []
+    for height, width in CHECK_SIZES:
+        map = random_map(height, width, seed=height)
+        expected = reference_smooth(map, 3)
+        smoothed = run.smooth_map(run.TileGrid.from_tiles(map.tiles.copy()),
+                                  3)
+        if not np.array_equal(smoothed.tiles, expected.tiles):
+            failures.append(f"{height}x{width}: smooth_map differs")
+
+        neighbours = run.NeighbourIndex(smoothed)
+        counts = np.array([[run.count_neighbours(smoothed, row, col, 1)
+                            for col in range(width)]
+                           for row in range(height)])
+        if not np.array_equal(neighbours.all_wall_neighbours(), counts):
+            failures.append(f"{height}x{width}: NeighbourIndex differs")
+        if not np.array_equal(run.wall_neighbour_counts(smoothed.tiles),
+                              counts):
+            failures.append(f"{height}x{width}: wall_neighbour_counts "
+                            "differs")
+    return failures
+
+
+def check_smooth_map_parallel():
+    """ smooth_map_parallel matches smooth_map, however many bands """
+    failures = []
+    with ProcessPoolExecutor(SMOOTH_WORKERS) as pool:
+        for height, width in CHECK_SIZES:
+            for workers in sorted({2, 3, height + 1}):
+                map = random_map(height, width, seed=width)
+                expected = run.smooth_map(
+                    run.TileGrid.from_tiles(map.tiles.copy()), 7)
+                smoothed = run.smooth_map_parallel(map, 7, workers, pool)
+                if not np.array_equal(smoothed.tiles, expected.tiles):
+                    failures.append(f"{height}x{width} in {workers} bands: "
+                                    "differs from smooth_map")
+    return failures
+
+
+def check_projectiles():
+    """ Every projectile backend plays the same fight """
+    failures = []
+    fights = {}
+    for name, backend in run.PROJECTILE_BACKENDS.items():
+        random.seed(0)
+        keys = random.Random(0)
+        fight = run.Fight(run.HeadlessWindow(None, 18, 60), backend())
+        states = []
+        for tick in range(CHECK_TICKS):
+            fight.move_player(ord(keys.choice("ad  ")))
+            fight.tick()
+            states.append((sorted(fight.projectiles.positions()),
+                           fight.goldilocks_x, fight.goldilocks_health,
+                           fight.player_x, fight.win, fight.defeat))
+        fights[name] = states
+    names = list(fights)
+    for name in names[1:]:
+        for tick, (state, expected) in enumerate(zip(fights[name],
+                                                     fights[names[0]])):
+            if state != expected:
+                failures.append(f"{name}: differs from {names[0]} at tick "
+                                f"{tick}")
+                break
+    return failures
+
+
+def check_pathfinding():
+    """
+    PathFinder's distance fields agree with its A* routes, and stay right
+    when tiles open up or close
+    """
+    failures = []
+    map = run.generate_map(CHECK_SEEDS[0])
+    rng = random.Random(0)
+    open_tiles = [tuple(tile) for tile in
+                  np.argwhere(run.PathFinder.walkable_tiles(map.tiles))]
+    target = (24, 40)  # Where the player starts
+    targets = {"start": target + target}
+    paths = run.PathFinder(map, targets=targets)
+    routes = []
+    for start in rng.sample(open_tiles, 20):
+        route = paths.find_path(start, target)
+        steps = len(route) - 1 if route else None
+        if paths.distance("start", *start) != steps:
+            failures.append(f"{start}: distance field and A* differ")
+        routes.append(route)
+
+    # Open a block of wall, then wall up a tile on a route, checking the
+    # updated field against one built from scratch
+    route = max(routes, key=len)
+    if len(route) < 3:
+        return failures + ["no routes to the start to check"]
+    for (top, left), size, tile in (((20, 60), 4, 0),
+                                    (route[len(route) // 2], 1, 1)):
+        map[top:top + size, left:left + size] = tile
+        paths.update(top, left, top + size - 1, left + size - 1)
+        fresh = run.PathFinder(map, targets=targets)
+        if not np.array_equal(paths.field("start"), fresh.field("start")):
+            failures.append(f"update({top}, {left}) left a stale distance "
+                            "field")
+    return failures
+
+
+def check_save_game():
+    """
+    save_game and load_game round trip a game, and a game saved part way
+    through then resumed ends the same as one played straight through
+    """
+    failures = []
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "game.sav")
+        session = run.Session()
+        session.seed = 2 ** 40 + 7
+        session.x, session.y = -3, 70000
+        session.inventory = {"Rock": 3, "Porridge": 1, "Bär": 65535}
+        session.edits = {(10, 20): 0, (-5, 2 ** 31 - 1): 3}
+        session.quest = session.goldilocks_spawned = True
+        for infinite in (False, True):
+            run.save_game(path, session, infinite)
+            loaded = run.Session()
+            if run.load_game(path, loaded) != infinite or any(
+                    getattr(loaded, name) != getattr(session, name)
+                    for name in ("seed", "x", "y", "inventory", "edits")
+                    + run.SAVE_FLAGS):
+                failures.append(f"infinite={infinite}: save_game then "
+                                "load_game changed the game")
+
+        for infinite in (False, True):
+            keys = rock_keys(run.prepare_map(infinite, 3, store=False))
+            straight = os.path.join(folder, "straight.sav")
+            resumed = os.path.join(folder, "resumed.sav")
+            whole = run.replay(keys, 3, infinite, save=straight)
+            cut = len(keys) // 2
+            run.replay(keys[:cut], 3, infinite, save=resumed)
+            rest = run.replay(keys[cut:], 3, infinite, save=resumed)
+            with open(straight, "rb") as file, open(resumed, "rb") as other:
+                same_save = file.read() == other.read()
+            if whole.screen_text() != rest.screen_text() or not same_save:
+                failures.append(f"infinite={infinite}: resumed game "
+                                "differs from one played straight through")
+    return failures
+
+
+CHECKS = {
+    "generate_map": check_generate_map,
+    "smooth_map": check_smooth_map,
+    "smooth_map_parallel": check_smooth_map_parallel,
+    "projectiles": check_projectiles,
+    "pathfinding": check_pathfinding,
+    "save_game": check_save_game,
+}
+
+
+def run_checks(pattern=None):
+    """
+    Runs the checks whose name contains pattern
+    Args:
+        pattern (str): Only run checks with this in their name
+    Returns:
+        failures (int): Number of checks that failed
+    """
+    failed = 0
+    for name, check in CHECKS.items():
+        if pattern and pattern not in name:
+            continue
+        failures = check()
+        print(f"{name:<40} {'FAILED' if failures else 'ok'}")
+        for failure in failures:
+            print(f"    {failure}")
+        failed += bool(failures)
+    return failed
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline
+    Args:
+        results (dict): Benchmark name: timings
+        baseline (dict): Benchmark name: timings, from an earlier run
+        threshold (float): Allowed slowdown, 0.2 allows 20% slower
+    Returns:
+        regressions (list): Names of the benchmarks that got too slow
+    """
+    regressions = []
+    print(f"\n{'benchmark':<40} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, timing in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["median"]
+        ratio = timing["median"] / before
+        slower = ratio > 1 + threshold
+        if slower:
+            regressions.append(name)
+        print(f"{name:<40} {before * 1000:8.3f}ms "
+              f"{timing['median'] * 1000:8.3f}ms {ratio - 1:+8.1%}"
+              f"{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(__doc__ or "").split("\n")[1])
+    parser.add_argument("-k", "--filter", metavar="TEXT",
+                        help="only run benchmarks (or checks) with TEXT in "
+                        "their name")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds to spend timing each benchmark")
+    parser.add_argument("--output", metavar="FILE",
+                        help="save the results to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE", nargs="?",
+                        const=BASELINE_PATH,
+                        help="compare with a baseline file (default "
+                        "benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown before failing, 0.2 is 20%%")
+    parser.add_argument("--check", action="store_true",
+                        help="check the optimised code's results instead "
+                        "of timing it")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if run_checks(args.filter) else 0)
+
+    results = run_benchmarks(args.filter, args.min_time)
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) more than "
+                  f"{args.threshold:.0%} slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
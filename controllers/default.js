@@ -1,13 +1,171 @@
 const Pty = require('node-pty');
 const fs = require('fs');
+const net = require('net');
+const { spawn } = require('child_process');
+
+// Number of ready-to-play maps to keep generated ahead of time (0 = off)
+const MAP_POOL_SIZE = parseInt(process.env.MAP_POOL_SIZE || '8');
+// Number of game processes kept started and waiting for a player (0 = off)
+const WORKER_POOL_SIZE = parseInt(process.env.WORKER_POOL_SIZE || '4');
+// Most game processes (waiting or playing) allowed at once
+const MAX_WORKERS = parseInt(process.env.MAX_WORKERS || '64');
+// Game output is gathered for this many milliseconds (or until it reaches
+// OUTPUT_MAX_LENGTH) and sent to the browser as one websocket message
+const OUTPUT_FLUSH_MS = parseInt(process.env.OUTPUT_FLUSH_MS || '8');
+const OUTPUT_MAX_LENGTH = 16384;
+// Unix socket of a game server that hosts every player in one process, see
+// run.py --serve. When unset, each player gets a game process of their own
+const GAME_SERVER_SOCKET = process.env.GAME_SERVER_SOCKET || '';
+// Every game plays today's map, shared read-only between the game
+// processes, see run.py --daily
+const DAILY_MAP = process.env.DAILY_MAP === '1';
+const GAME_ARGS = DAILY_MAP ? ['--daily'] : [];
+// Games are saved here, one file per browser, so a player who disconnects
+// can pick up where they left off
+const SAVE_DIR = process.env.SAVE_DIR || '.saves';
+
+const idleWorkers = [];
+let workerCount = 0;
+// Pending delayed refill of the worker pool, see refillLater
+let refillTimer = null;
 
 exports.install = function () {
 
     ROUTE('/');
     WEBSOCKET('/', socket, ['raw']);
 
+    if (GAME_SERVER_SOCKET) {
+        startGameServer();
+        return;
+    }
+
+    if (MAP_POOL_SIZE > 0 && !DAILY_MAP) {
+        startMapPool();
+    }
+
+    refillWorkers();
+
 };
 
+// Starts a game process on a pty. Warm workers load the game and its map,
+// then wait for a newline before starting, see run.py --warm
+function spawnWorker(warm, save) {
+
+    const args = ['run.py', ...GAME_ARGS];
+    if (warm) {
+        args.push('--warm');
+    }
+    if (save) {
+        args.push('--save', save);
+    }
+
+    const tty = Pty.spawn('python3', args, {
+        name: 'xterm-color',
+        cols: 80,
+        rows: 24,
+        cwd: process.env.PWD,
+        env: process.env
+    });
+    tty.warm = warm;
+    workerCount++;
+
+    tty.on('exit', function () {
+        workerCount--;
+        const index = idleWorkers.indexOf(tty);
+        if (index !== -1) {
+            // Stopped before a player got it, most likely it couldn't
+            // start, so wait a while before trying again
+            idleWorkers.splice(index, 1);
+            refillLater(5000);
+        } else {
+            setImmediate(refillWorkers);
+        }
+    });
+
+    return tty;
+}
+
+// Tops the idle worker pool back up, without going over MAX_WORKERS
+function refillWorkers() {
+    while (idleWorkers.length < WORKER_POOL_SIZE && workerCount < MAX_WORKERS) {
+        idleWorkers.push(spawnWorker(true));
+    }
+}
+
+// Tops the idle worker pool back up after a pause, once however many
+// workers stop in the meantime
+function refillLater(delay) {
+    if (!refillTimer) {
+        refillTimer = setTimeout(function () {
+            refillTimer = null;
+            refillWorkers();
+        }, delay);
+    }
+}
+
+// Hands out an idle worker, or starts a new game (resuming the save file
+// if given) if none are waiting. Returns null if MAX_WORKERS are already
+// running
+function takeWorker(save) {
+    if (GAME_SERVER_SOCKET) {
+        return connectSession();
+    }
+    let tty = idleWorkers.shift();
+    if (!tty && workerCount < MAX_WORKERS) {
+        tty = spawnWorker(false, save);
+    }
+    setImmediate(refillWorkers);
+    return tty || null;
+}
+
+// Background process that keeps the map pool topped up, so new games
+// take a finished map instead of generating one
+function startMapPool() {
+
+    const pool = spawn('python3', ['run.py', '--map-pool', String(MAP_POOL_SIZE)], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'ignore'
+    });
+
+    pool.on('exit', function (code, signal) {
+        console.log("Map pool stopped, restarting");
+        setTimeout(startMapPool, 5000);
+    });
+}
+
+// Game server process hosting every player, restarted if it stops
+function startGameServer() {
+
+    const server = spawn('python3', ['run.py', '--serve', GAME_SERVER_SOCKET, ...GAME_ARGS], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'ignore'
+    });
+
+    server.on('exit', function (code, signal) {
+        console.log("Game server stopped, restarting");
+        setTimeout(startGameServer, 5000);
+    });
+}
+
+// Starts a session on the game server. The connection gets the same data
+// and exit events, write and kill as a worker's pty
+function connectSession() {
+    const session = net.createConnection(GAME_SERVER_SOCKET);
+    session.setEncoding('utf8');
+    session.on('error', function () {
+        session.destroy();
+    });
+    session.on('close', function () {
+        session.emit('exit');
+    });
+    session.kill = function () {
+        session.destroy();
+    };
+    return session;
+}
+
 function socket() {
 
     this.encodedecode = false;
@@ -15,30 +173,49 @@ function socket() {
 
     this.on('open', function (client) {
 
-        // Spawn terminal
-        client.tty = Pty.spawn('python3', ['run.py'], {
-            name: 'xterm-color',
-            cols: 80,
-            rows: 24,
-            cwd: process.env.PWD,
-            env: process.env
-        });
+        // The browser's save id, see views/index.html
+        const id = (client.query || {}).save;
+        client.save = /^[0-9a-f]{32}$/.test(id || '') ? `${SAVE_DIR}/${id}.sav` : '';
+
+        // Attach a game process
+        client.tty = takeWorker(client.save);
+        if (!client.tty) {
+            client.send("Server is full, please try again later\r\n");
+            client.close();
+            return;
+        }
+
+        client.output = [];
+        client.outputLength = 0;
+        client.outputTimer = null;
 
         client.tty.on('exit', function (code, signal) {
+            flushOutput(client);
             client.tty = null;
             client.close();
             console.log("Process killed");
         });
 
         client.tty.on('data', function (data) {
-            client.send(data);
+            queueOutput(client, data);
         });
 
+        // Start the game in a warm worker, resuming the player's save
+        if (client.tty.warm) {
+            client.tty.write(client.save + '\n');
+        }
+
     });
 
     this.on('close', function (client) {
+        if (client.outputTimer) {
+            clearTimeout(client.outputTimer);
+            client.outputTimer = null;
+        }
         if (client.tty) {
-            client.tty.kill(9);
+            // SIGHUP, like closing a terminal, lets the game save its
+            // profile before exiting
+            client.tty.kill('SIGHUP');
             client.tty = null;
             console.log("Process killed and terminal unloaded");
         }
@@ -49,6 +226,31 @@ function socket() {
     });
 }
 
+// Adds game output to the client's next websocket message
+function queueOutput(client, data) {
+    client.output.push(data);
+    client.outputLength += data.length;
+
+    if (client.outputLength >= OUTPUT_MAX_LENGTH) {
+        flushOutput(client);
+    } else if (!client.outputTimer) {
+        client.outputTimer = setTimeout(flushOutput, OUTPUT_FLUSH_MS, client);
+    }
+}
+
+// Sends all queued game output as one websocket message
+function flushOutput(client) {
+    if (client.outputTimer) {
+        clearTimeout(client.outputTimer);
+        client.outputTimer = null;
+    }
+    if (client.output.length) {
+        client.send(client.output.join(''));
+        client.output = [];
+        client.outputLength = 0;
+    }
+}
+
 if (process.env.CREDS != null) {
     console.log("Creating creds.json file.");
     fs.writeFile('creds.json', process.env.CREDS, 'utf8', function (err) {
@@ -1,6 +1,31 @@
+import argparse
+import asyncio
+import atexit
+import contextlib
+import cProfile
 import curses as c
+import functools
+import hashlib
+import heapq
+import io
+import json
+import math
+import os
+import queue
 import random
+import signal
+import struct
+import sys
+import threading
 import time
+import unicodedata
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, overload
+
+import numpy as np
 
 ROWS = 75
 COLS = 250
@@ -18,77 +43,1227 @@ PORRIDGE_Y = 28
 PLAYER_ICON = "☺"
 
 
-def build_map(height, width, fill_percent):
+class Compositor():
+    """
+    Collects the windows updated during a frame and sends them all to the
+    terminal at the end of the frame with a single c.doupdate(), instead
+    of each window.refresh() writing to the terminal separately
+    """
+
+    def __init__(self):
+        self.pending = False  # True if windows were queued since show()
+
+    def update(self, window, *pad_args):
+        """
+        Queues a window to be shown at the end of the frame
+        Args:
+            window (window): Window or pad that changed
+            pad_args (int): For pads, the same arguments as pad.refresh
+        """
+        window.noutrefresh(*pad_args)
+        self.pending = True
+
+    def show(self):
+        """ Sends every window queued this frame to the terminal """
+        if self.pending:
+            c.doupdate()
+            self.pending = False
+
+
+class Session():
+    """
+    Everything that belongs to one player's game: the screen/keyboard
+    backend and clock it runs on, its frame and HUD windows, and the
+    player's position, inventory and quest progress. A thread plays one
+    session at a time (see use_session), the terminal game plays the
+    default session
+    """
+
+    __slots__ = ("backend", "clock", "frame", "coords_win", "quest_win",
+                 "controls_win", "inv_win", "seed", "edits", "x", "y",
+                 "inventory", "quest", "quest_complete",
+                 "goldilocks_spawned", "show_goldilocks", "show_porridge")
+
+    def __init__(self, backend=c, clock=time):
+        self.backend = backend  # curses, or a stand-in like HeadlessCurses
+        self.clock = clock  # time, or a stand-in with monotonic and sleep
+        self.frame = Compositor()
+        # HUD windows, created once and then updated in place
+        self.coords_win: Any = None
+        self.quest_win: Any = None
+        self.controls_win: Any = None
+        self.inv_win: Any = None
+        self.seed: int | None = None  # World seed of the map, if it's known
+        self.edits = {}  # Map tiles the player changed, (row, col): tile
+        # Map position at the top left of the view, the player is at map
+        # row y + 12, column x + 40
+        self.x = 0
+        self.y = 12
+        self.inventory = {"Rock": 0, "Porridge": 0}
+        self.quest = False  # True while the porridge quest is on
+        self.quest_complete = False
+        self.goldilocks_spawned = False  # True once the quest spawned her
+        self.show_goldilocks = False
+        self.show_porridge = False
+
+
+class SessionAttribute():
+    """
+    Stands in for an attribute of the current thread's session, so module
+    level names like c and frame follow whichever session is playing
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_session(), self.name), attr)
+
+
+_sessions = threading.local()
+terminal_session = Session()
+
+
+def current_session():
+    """ Returns the session the current thread is playing """
+    return getattr(_sessions, "session", terminal_session)
+
+
+def use_session(session=None):
+    """
+    Makes the current thread play a session
+    Args:
+        session (Session): Session to play, the terminal game if None
+    """
+    _sessions.session = terminal_session if session is None else session
+
+
+# Screen/keyboard backend, frame and clock of the current session. The
+# terminal game plays on curses and the real clock
+TERMINAL = c
+c = SessionAttribute("backend")
+frame = SessionAttribute("frame")
+clock = SessionAttribute("clock")
+
+# Timings kept per measurement for percentiles, and the smallest bucket of
+# the timing histograms (buckets double in size from there)
+TELEMETRY_RING = 1024
+TELEMETRY_BUCKET = 1e-6
+
+
+class TimingLog():
+    """
+    Timings of one measurement: a ring buffer of the latest timings, for
+    percentiles, and a histogram of every timing with power of 2 buckets
     """
-    Returns a 2d array height x width with 1's on the border and a random
+
+    __slots__ = ("ring", "index", "count", "total", "longest", "buckets")
+
+    def __init__(self):
+        self.ring = [0.0] * TELEMETRY_RING
+        self.index = 0  # Next slot of the ring to write
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.buckets = {}  # bucket number: count
+
+    def add(self, seconds):
+        self.ring[self.index] = seconds
+        self.index = (self.index + 1) % TELEMETRY_RING
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        # Bucket n holds timings from 2**(n-1) to 2**n smallest buckets
+        bucket = max(math.frexp(seconds / TELEMETRY_BUCKET)[1], 0)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict): Count, total, mean and max of every timing,
+                            percentiles of the latest timings, and the
+                            histogram, all in milliseconds
+        """
+        recent = sorted(self.ring[:min(self.count, TELEMETRY_RING)])
+
+        def percentile(fraction):
+            return recent[min(int(len(recent) * fraction),
+                              len(recent) - 1)] * 1000
+
+        histogram = {}
+        for bucket in sorted(self.buckets):
+            top = TELEMETRY_BUCKET * 2 ** bucket * 1000
+            histogram[f"<{top:g}ms"] = self.buckets[bucket]
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total / self.count * 1000,
+            "max_ms": self.longest * 1000,
+            "recent_p50_ms": percentile(0.5),
+            "recent_p90_ms": percentile(0.9),
+            "recent_p99_ms": percentile(0.99),
+            "histogram": histogram,
+        }
+
+
+class Telemetry():
+    """
+    Optional timings of map generation, frames and fight ticks, turned on
+    with run.py --profile FILE or the GAME_PROFILE environment variable,
+    and written to FILE as JSON when the game exits. A "{pid}" in the file
+    name is replaced with the process id. With --pstats FILE (or
+    GAME_PSTATS) the whole run is also profiled with cProfile. cProfile
+    only follows the thread that turned it on, so under --serve it profiles
+    the event loop and not the games' threads.
+    The files are also written when the process is hung up on or
+    terminated. When off, each measurement point costs one attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.logs = {}  # measurement name: TimingLog
+        self.path = ""
+        self.profiler = None
+        self.pstats_path = ""
+
+    def enable(self, path, pstats_path=None):
+        """
+        Starts recording, and dumps everything recorded when the process
+        exits
+        Args:
+            path (str): JSON file for the timings
+            pstats_path (str): File for cProfile stats, not profiled if None
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        self.path = path.replace("{pid}", str(os.getpid()))
+        if pstats_path:
+            self.pstats_path = pstats_path.replace("{pid}", str(os.getpid()))
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        atexit.register(self.dump)
+        # A hangup (the terminal or controller went away) or kill skips
+        # atexit, so dump before dying from those too
+        if threading.current_thread() is threading.main_thread():
+            for name in ("SIGHUP", "SIGTERM"):
+                if hasattr(signal, name):
+                    signal.signal(getattr(signal, name), self.dump_and_die)
+
+    def now(self):
+        """ Start time for record(), 0 when off """
+        return time.perf_counter() if self.enabled else 0.0
+
+    def record(self, name, start):
+        """
+        Records the time since start under a name
+        Args:
+            name (str): Measurement name
+            start (float): Time from now()
+        """
+        if self.enabled:
+            log = self.logs.get(name)
+            if log is None:
+                log = self.logs[name] = TimingLog()
+            log.add(time.perf_counter() - start)
+
+    def timed(self, name):
+        """ Decorator recording the time of every call to a function """
+        def decorator(func):
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, start)
+            return timed_func
+        return decorator
+
+    def dump(self):
+        """ Writes the timings (and cProfile stats) recorded so far """
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.pstats_path)
+        with open(self.path, "w") as file:
+            json.dump({name: log.summary()
+                       for name, log in sorted(self.logs.items())},
+                      file, indent=2)
+
+    def dump_and_die(self, signum, frame):
+        """
+        Signal handler dumping what was recorded, then dying from the
+        signal as the process would have without the handler
+        Args:
+            signum (int): Signal received
+            frame (frame): Frame the signal interrupted
+        """
+        atexit.unregister(self.dump)
+        self.dump()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+telemetry = Telemetry()
+if os.environ.get("GAME_PROFILE"):
+    telemetry.enable(os.environ["GAME_PROFILE"],
+                     os.environ.get("GAME_PSTATS"))
+
+# Size of the visible map area, and the extra map drawn around it so
+# the player can move a few tiles before new strips need painting
+VIEW_ROWS = 23
+VIEW_COLS = 61
+VIEW_MARGIN = 12
+
+# Map painting keeps the runs of same-attribute tiles of each row segment
+RUN_SEGMENT = 64  # Columns per cached row segment
+RUN_CACHE = 4096  # Max row segments kept, shared by every game
+
+# Fog of war (run.py --fog): how far the player can see, in tiles, and
+# how many positions' fields of view are kept
+FOV_RADIUS = 10
+FOV_CACHE = 256
+
+# Endless (chunked) world settings. Chunks are generated with a margin of
+# neighbouring map around them, wider than the number of smoothing
+# passes, so cave walls line up across chunk edges
+CHUNK_SIZE = 64
+CHUNK_MARGIN = 8
+CHUNK_CACHE = 64  # Max chunks kept in memory
+WORLD_LIMIT = 2 ** 31  # Endless world size, in tiles
+
+# Maps with at least this many tiles are smoothed in SMOOTH_WORKERS
+# processes (smooth_map_parallel). Below it starting the processes costs
+# more than the smoothing
+PARALLEL_SMOOTH_TILES = 4_000_000
+SMOOTH_WORKERS = int(os.environ.get("SMOOTH_WORKERS", os.cpu_count() or 1))
+
+# Finished maps are cached here, keyed by the settings they were made with
+MAP_CACHE_DIR = os.environ.get(
+    "MAP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".map_cache"))
+# Map file header: magic, format version, height, width, bear y, bear x
+MAP_FILE_HEADER = struct.Struct("<4sHIIii")
+MAP_FILE_MAGIC = b"TAMP"
+MAP_FILE_VERSION = 2
+
+# Ready-to-play maps kept by the map pool producer (run.py --map-pool N)
+MAP_POOL_DIR = os.environ.get(
+    "MAP_POOL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".map_pool"))
+
+# Saved games (run.py --save FILE). A save is the world seed and what the
+# player changed, the map itself is made again from the seed on resume
+# Save file header: magic, format version, seed, flags, x, y, number of
+# inventory items, number of tile changes
+SAVE_FILE_HEADER = struct.Struct("<4sHqBiiBI")
+SAVE_FILE_MAGIC = b"TASV"
+SAVE_FILE_VERSION = 1
+SAVE_ITEM = struct.Struct("<BH")  # Name length (name follows), quantity
+SAVE_EDIT = struct.Struct("<iiB")  # Row, column, tile
+# Session flags kept as one bit each in the header, in this order
+SAVE_FLAGS = ("quest", "quest_complete", "goldilocks_spawned",
+              "show_goldilocks", "show_porridge")
+SAVE_INFINITE = 1 << len(SAVE_FLAGS)  # Flag bit for an endless world
+
+# Fight minigame projectile storage: "objects" (pooled Projectile objects)
+# or "arrays" (NumPy arrays, faster with many projectiles)
+PROJECTILE_BACKEND = os.environ.get("PROJECTILE_BACKEND", "objects")
+
+
+class TileGrid():
+    """
+    Compact 2D map of tiles, one byte per tile, backed by a single
+    contiguous NumPy uint8 array.
+    grid[row] returns a zero-copy view of that row, so grid[row][col]
+    reads and writes tiles just like the old list of lists did.
+    grid[row, col] reads/writes a single tile directly.
+    """
+
+    def __init__(self, height, width, fill=0):
+        self.tiles = np.full((height, width), fill, dtype=np.uint8)
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """
+        Wraps an existing 2D uint8 array (e.g. a memory map) without
+        copying it
+        Args:
+          tiles (ndarray): 2D uint8 array of map tiles
+        """
+        map = cls.__new__(cls)
+        map.tiles = tiles
+        return map
+
+    @property
+    def height(self):
+        return self.tiles.shape[0]
+
+    @property
+    def width(self):
+        return self.tiles.shape[1]
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self):
+        return iter(self.tiles)
+
+    @overload
+    def __getitem__(self, index: tuple[int, int]) -> int: ...
+
+    @overload
+    def __getitem__(self, index: int | slice | tuple[int | slice, slice]
+                    | tuple[slice, int]) -> np.ndarray: ...
+
+    def __getitem__(self, index):
+        tiles = self.tiles[index]
+        if isinstance(tiles, np.generic):
+            return int(tiles)  # Single tile
+        return tiles
+
+    def __setitem__(self, index, value):
+        self.tiles[index] = value
+
+    def smooth(self, iterations=1):
+        """
+        Runs the cellular automata smoothing pass "iterations" times in
+        place. Scratch buffers are allocated once per call and the two
+        tile buffers are swapped between passes, so no new map is
+        allocated per pass.
+        Note: row views taken before smoothing are not updated
+        Args:
+          iterations (int): Number of smoothing passes
+        """
+        front = self.tiles
+        back = np.empty_like(front)
+        walls = np.ones((self.height + 2, self.width + 2), dtype=np.uint8)
+        counts = np.empty_like(front)
+
+        for ind in range(iterations):
+            started = telemetry.now()
+            wall_neighbour_counts(front, walls, counts)
+            # 4 or more wall neighbours makes a wall, otherwise open space
+            np.greater_equal(counts, 4, out=back)
+            front, back = back, front
+            telemetry.record("smooth_map_pass", started)
+
+        self.tiles = front
+
+
+@telemetry.timed("build_map")
+def build_map(height, width, fill_percent,
+              rng: random.Random | None = None):
+    """
+    Returns a height x width TileGrid with 1's on the border and a random
     weighted fill of 1's for wall and 0's for open space
     Args:
     height (int): Map height
     width (int): Map width
     fill_percent (float): Percentage of map area that is 1's (or wall)
+    rng (random.Random): Random number generator used for the fill, the
+                         random module if None
 
     Returns:
-    map (list): Map 2D list
+    map (TileGrid): Map grid
     """
-    map = [
-        random.choices([0, 1], [1 - fill_percent, fill_percent], k=width)
-        for x in range(height)
-    ]  # fills map grid with 1's and 0's, fill_percent determines number of 1's
+    choices = random.choices if rng is None else rng.choices
+    map = TileGrid(height, width)
+    # fills map grid with 1's and 0's, fill_percent determines number of 1's
+    for row in range(height):
+        map[row] = choices([0, 1], [1 - fill_percent, fill_percent],
+                           k=width)
 
     # Set map border to 1's
-    map[0] = [1] * width
-    map[height - 1] = [1] * width
-    for ind in range(1, height - 1):
-        map[ind][0] = 1
-        map[ind][width - 1] = 1
+    map[0] = 1
+    map[height - 1] = 1
+    map[:, 0] = 1
+    map[:, width - 1] = 1
 
     return map
 
 
-def draw_map(screen, map: list[list[int]], colors: dict):
+@telemetry.timed("draw_map")
+def draw_map(screen, map: TileGrid, colors: dict):
     """
     Draws the map "map" on the screen "screen", using color pairs
     found in the colors list. Adds in bear, goldilocks, and porridge avatars
     Args:
       screen (window): The window on which the map is drawn
-      map (list): Map 2D list
+      map (TileGrid): Map grid
       colors (dict): The dict of color pairs to be used in the drawing
     """
+    # tile value -> color pair, looked up once instead of once per tile
+    attrs = list(colors.values())
+
+    # One addstr per run of tiles with the same color pair
+    for row in range(map.height):
+        for col, text, attr in tile_runs(map[row], attrs):
+            screen.addstr(row, col, text, attr)
+
+    draw_avatars(screen)
 
-    for row in range(len(map)):
-        for col in range(len(map[row])):
-            if map[row][col] == 3:
-                screen.addch(row, col, "•",
-                             list(colors.values())[map[row][col]])
-            else:
-                screen.addch(row, col, " ",
-                             list(colors.values())[map[row][col]])
 
-    # add avatars and adjacent tiles to map
+def tile_runs(tiles, attrs):
+    """
+    Splits a row of tiles into runs of tiles drawn with the same attribute,
+    so each run can be drawn with one addstr
+    Args:
+      tiles (ndarray): 1D array of map tiles
+      attrs (list): Attribute (color pair) of each tile value
+    Returns:
+      runs (list): (col, text, attr) of each run, col is the index of its
+                   first tile
+    """
+    codes = np.asarray(attrs)[tiles]
+    starts = [0, *(np.flatnonzero(codes[1:] != codes[:-1]) + 1).tolist()]
+    ends = starts[1:] + [len(codes)]
+    glyphs = "".join([tile_glyph(tile) for tile in tiles.tolist()])
+    return [(start, glyphs[start:end], attrs[tiles[start]])
+            for start, end in zip(starts, ends)]
+
+
+def tile_glyph(tile):
+    """
+    Returns the character used to draw a map tile
+    Args:
+      tile (int): Map tile value
+    Returns:
+      glyph (str): "•" for rocks, " " for everything else
+    """
+    if tile == 3:
+        return "•"
+    return " "
+
+
+def draw_avatars(screen):
+    """
+    Adds bear, goldilocks, and porridge avatars to the screen
+    Args:
+      screen (window): The window on which the map is drawn
+    """
     screen.addstr(BEAR_Y, BEAR_X, "🐻")
     screen.addstr(GOLDILOCKS_Y, GOLDILOCKS_X, "👧")
     screen.addstr(PORRIDGE_Y, PORRIDGE_X, "🥣")
 
 
-def smooth_map(map: list[list[int]]):
+class Viewport():
+    """
+    Small pad holding only the visible part of the map plus a margin
+    around it. Takes map (world) coordinates and clips anything outside
+    the area it holds, so memory and draw time depend on the terminal
+    size rather than the map size.
+    """
+
+    def __init__(self, height, width, margin, screen_y=0, screen_x=0):
+        self.height = height
+        self.width = width
+        self.margin = margin
+        self.screen_y = screen_y
+        self.screen_x = screen_x
+        self.rows = height + 2 * margin
+        self.cols = width + 2 * margin
+        # Extra row and column: curses can't write the bottom right cell
+        self.pad = c.newpad(self.rows + 1, self.cols + 1)
+        self.back = c.newpad(self.rows + 1, self.cols + 1)
+        # Map coordinates of the top left cell of the pad
+        self.top = 0
+        self.left = 0
+
+    def bounds(self):
+        """
+        Returns:
+            bounds (tuple): (top, left, bottom, right) map coordinates held
+                            by the pad, inclusive
+        """
+        return (self.top, self.left,
+                self.top + self.rows - 1, self.left + self.cols - 1)
+
+    def holds(self, y, x):
+        """
+        Checks whether the view with top left corner y, x is in the pad
+        Args:
+            y (int): Map row at the top of the view
+            x (int): Map column at the left of the view
+        """
+        return (self.top <= y and y + self.height <= self.top + self.rows and
+                self.left <= x and x + self.width <= self.left + self.cols)
+
+    def addstr(self, row, col, text, attr=0):
+        """ Same as window.addstr, in map coordinates, clipped to the pad """
+        row -= self.top
+        col -= self.left
+        if not 0 <= row < self.rows or col >= self.cols:
+            return
+        if col < 0:
+            text, col = text[-col:], 0
+        if text:
+            self.pad.addstr(row, col, text[:self.cols - col], attr)
+
+    def addch(self, row, col, ch, attr=0):
+        """ Same as window.addch, in map coordinates, clipped to the pad """
+        row -= self.top
+        col -= self.left
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            self.pad.addch(row, col, ch, attr)
+
+    def move(self, top, left):
+        """
+        Moves the pad to hold the map from top, left. The part of the map
+        already drawn is copied across, everything else is left blank.
+        Args:
+            top (int): New top map row
+            left (int): New left map column
+        Returns:
+            strips (list): (top, left, bottom, right) map areas that still
+                           need painting
+        """
+        old_top, old_left, old_bottom, old_right = self.bounds()
+        self.top, self.left = top, left
+        top, left, bottom, right = self.bounds()
+
+        # Overlap between the old and new areas
+        overlap_top = max(top, old_top)
+        overlap_bottom = min(bottom, old_bottom)
+        overlap_left = max(left, old_left)
+        overlap_right = min(right, old_right)
+
+        self.back.erase()
+        if overlap_top > overlap_bottom or overlap_left > overlap_right:
+            self.pad, self.back = self.back, self.pad
+            return [(top, left, bottom, right)]
+
+        self.pad.overwrite(self.back,
+                           overlap_top - old_top, overlap_left - old_left,
+                           overlap_top - top, overlap_left - left,
+                           overlap_bottom - top, overlap_right - left)
+        self.pad, self.back = self.back, self.pad
+
+        # Newly exposed rows above/below the overlap, then columns either
+        # side of it
+        strips = []
+        if top < overlap_top:
+            strips.append((top, left, overlap_top - 1, right))
+        if bottom > overlap_bottom:
+            strips.append((overlap_bottom + 1, left, bottom, right))
+        if left < overlap_left:
+            strips.append((overlap_top, left, overlap_bottom,
+                           overlap_left - 1))
+        if right > overlap_right:
+            strips.append((overlap_top, overlap_right + 1, overlap_bottom,
+                           right))
+        return strips
+
+    def refresh(self, y, x):
+        """
+        Shows the map from y, x on screen. The view must be in the pad
+        Args:
+            y (int): Map row at the top of the view
+            x (int): Map column at the left of the view
+        """
+        self.pad.refresh(y - self.top, x - self.left,
+                         self.screen_y, self.screen_x,
+                         self.screen_y + self.height - 1,
+                         self.screen_x + self.width - 1)
+
+    def noutrefresh(self, y, x):
+        """ Same as refresh, but shown on the next frame.show() """
+        frame.update(self.pad, y - self.top, x - self.left,
+                     self.screen_y, self.screen_x,
+                     self.screen_y + self.height - 1,
+                     self.screen_x + self.width - 1)
+
+
+class RunCache():
+    """
+    Runs of same-attribute tiles (see tile_runs) of recently painted row
+    segments, looked up by the segment's tiles. Segments with the same
+    tiles share one entry wherever they are on the map, so one cache
+    (row_runs) serves every MapRenderer, including every player of the
+    game server
+    """
+
+    def __init__(self, size=RUN_CACHE):
+        self.size = size
+        self.entries = OrderedDict()  # (attrs, tile bytes): runs
+        self.lock = threading.Lock()  # Game server sessions share it
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def runs(self, tiles, attrs):
+        """
+        Runs of a row segment, made once and reused while they're cached
+        Args:
+            tiles (ndarray): The segment's tiles, as drawn
+            attrs (tuple): Attribute (color pair) of each tile value
+        Returns:
+            runs (list): (col, text, attr) of each run, col is relative to
+                         the segment's first tile
+        """
+        key = (attrs, tiles.tobytes())
+        with self.lock:
+            runs = self.entries.get(key)
+            if runs is not None:
+                self.entries.move_to_end(key)
+                return runs
+        runs = tile_runs(tiles, attrs)
+        with self.lock:
+            self.entries[key] = runs
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return runs
+
+
+row_runs = RunCache()
+
+
+class MapRenderer():
+    """
+    Keeps a Viewport in sync with a map. Only the part of the map held by
+    the viewport is ever drawn: strips are painted as they scroll into
+    view, and flush() repaints only tiles that changed since they were
+    last drawn. Avatars (bear, goldilocks, porridge) are sprites drawn on
+    top of the map.
+    Tiles are drawn a run of same-attribute tiles at a time, and the runs
+    of each row segment are kept in row_runs.
+    """
+
+    def __init__(self, view: Viewport,
+                 map: "TileGrid | MapOverlay | ChunkManager", colors: dict):
+        self.view = view
+        self.map = map
+        self.colors = colors
+        # tile value -> color pair, looked up once
+        self.attrs = tuple(colors.values())
+        self.sprites = {}  # (row, col): text
+        self.drawn = None  # Copy of the tiles in the viewport, as drawn
+        self.drawn_area = None  # (top, left, bottom, right) of drawn
+        self.painted = False  # True once the viewport has been drawn
+        # Tiles the player can see in fog of war mode, None shows everything
+        self.visible = None
+        self.runs = row_runs  # Runs of recently painted row segments
+
+    def clip(self, top, left, bottom, right):
+        """ Clips an area to the map, returns None if it's off the map """
+        top, left = max(top, 0), max(left, 0)
+        bottom = min(bottom, self.map.height - 1)
+        right = min(right, self.map.width - 1)
+        if top > bottom or left > right:
+            return None
+        return top, left, bottom, right
+
+    @telemetry.timed("paint")
+    def paint(self, top, left, bottom, right):
+        """
+        Paints the tiles and sprites in an area of the map
+        Args:
+            top (int): Top row
+            left (int): Left column
+            bottom (int): Bottom row (inclusive)
+            right (int): Right column (inclusive)
+        """
+        area = self.clip(top, left, bottom, right)
+        if area is not None:
+            top, left, bottom, right = area
+            # Whole row segments, so their runs can be cached
+            first = left // RUN_SEGMENT * RUN_SEGMENT
+            last = min(right // RUN_SEGMENT * RUN_SEGMENT + RUN_SEGMENT - 1,
+                       self.map.width - 1)
+            tiles = self.map[top:bottom + 1, first:last + 1]
+            if self.visible is not None:
+                tiles = self.hide(tiles, top, first)
+            for row, row_tiles in enumerate(tiles, top):
+                for start in range(first, last + 1, RUN_SEGMENT):
+                    segment = row_tiles[start - first:
+                                        start - first + RUN_SEGMENT]
+                    for col, text, attr in self.runs.runs(segment,
+                                                          self.attrs):
+                        # Only draw the part of the run inside the area
+                        col += start
+                        end = col + len(text) - 1
+                        if end < left or col > right:
+                            continue
+                        text = text[max(left - col, 0):
+                                    len(text) - max(end - right, 0)]
+                        self.view.addstr(row, max(col, left), text, attr)
+
+        for (row, col), text in self.sprites.items():
+            if (top <= row <= bottom and left <= col <= right
+                    and self.sees(row, col)):
+                self.view.addstr(row, col, text)
+
+    def hide(self, tiles, top, left):
+        """
+        Blanks the tiles the player can't see in fog of war mode
+        Args:
+            tiles (ndarray): Area of the map
+            top (int): Map row of the area's first row
+            left (int): Map column of the area's first column
+        Returns:
+            tiles (ndarray): Copy of the area, unseen tiles set to 0
+        """
+        seen = np.zeros(tiles.shape, dtype=bool)
+        height, width = tiles.shape
+        for row, col in self.visible or ():
+            if 0 <= row - top < height and 0 <= col - left < width:
+                seen[row - top, col - left] = True
+        return np.where(seen, tiles, 0).astype(np.uint8)
+
+    def snapshot(self):
+        """ Remembers the tiles held by the viewport as drawn """
+        self.drawn_area = self.clip(*self.view.bounds())
+        if self.drawn_area is None:
+            self.drawn = None
+            return
+        top, left, bottom, right = self.drawn_area
+        self.drawn = self.map[top:bottom + 1, left:right + 1].copy()
+
+    def draw(self):
+        """ Paints everything held by the viewport """
+        self.view.pad.erase()
+        self.paint(*self.view.bounds())
+        self.snapshot()
+        self.painted = True
+
+    def draw_tile(self, row, col):
+        """
+        Repaints a single map tile
+        Args:
+            row (int): Tile row index
+            col (int): Tile column index
+        """
+        if not self.sees(row, col):
+            self.view.addch(row, col, " ", self.attrs[0])
+            return
+        tile = self.map[row, col]
+        self.view.addch(row, col, tile_glyph(tile), self.attrs[tile])
+
+    def sees(self, row, col):
+        """ Checks whether a tile is in view (always, without fog of war) """
+        return self.visible is None or (row, col) in self.visible
+
+    def reveal(self, visible):
+        """
+        Sets the tiles the player can see, repainting only the tiles that
+        came into or went out of view
+        Args:
+            visible (set): (row, col) of every visible tile
+        Returns:
+            count (int): Number of tiles repainted
+        """
+        changed = (visible ^ self.visible if self.visible is not None
+                   else set())
+        self.visible = visible
+        if not self.painted:
+            return 0  # Drawn with the new view on the first scroll()
+
+        for row, col in changed:
+            self.draw_tile(row, col)
+        for (row, col), text in self.sprites.items():
+            # Emoji avatars are 2 tiles wide
+            if (row, col) in changed or (row, col + 1) in changed:
+                self.paint(row, col, row, col + 1)
+        return len(changed)
+
+    def flush(self):
+        """
+        Repaints the tiles in the viewport that changed since they were
+        last drawn, and the sprites on top of them
+        Returns:
+            count (int): Number of tiles repainted
+        """
+        if self.drawn_area is None or self.drawn is None:
+            return 0
+
+        top, left, bottom, right = self.drawn_area
+        tiles = self.map[top:bottom + 1, left:right + 1]
+        changed = np.argwhere(tiles != self.drawn).tolist()
+        for row, col in changed:
+            self.draw_tile(top + row, left + col)
+        if changed:
+            self.drawn[:] = tiles
+            for (row, col), text in self.sprites.items():
+                if self.sees(row, col):
+                    self.view.addstr(row, col, text)
+        return len(changed)
+
+    def show_sprite(self, row, col, text):
+        """
+        Draws an avatar on the map, and keeps it there while scrolling
+        Args:
+            row (int): Map row
+            col (int): Map column
+            text (str): Avatar to draw
+        """
+        self.sprites[(row, col)] = text
+        if self.sees(row, col):
+            self.view.addstr(row, col, text)
+
+    def hide_sprite(self, row, col):
+        """
+        Removes an avatar and repaints the map underneath it
+        Args:
+            row (int): Map row
+            col (int): Map column
+        """
+        if self.sprites.pop((row, col), None) is not None:
+            # Emoji avatars are 2 tiles wide
+            self.paint(row, col, row, col + 1)
+
+    def refresh(self, y, x):
+        """
+        Shows the map from y, x on screen, painting any part of the map
+        that scrolled into the viewport
+        Args:
+            y (int): Map row at the top of the view
+            x (int): Map column at the left of the view
+        """
+        self.scroll(y, x)
+        self.view.refresh(y, x)
+
+    def noutrefresh(self, y, x):
+        """ Same as refresh, but shown on the next frame.show() """
+        self.scroll(y, x)
+        self.view.noutrefresh(y, x)
+
+    def scroll(self, y, x):
+        """
+        Makes sure the viewport holds the view from y, x, painting any part
+        of the map that scrolled into it
+        Args:
+            y (int): Map row at the top of the view
+            x (int): Map column at the left of the view
+        """
+        margin = self.view.margin
+        if not self.painted:
+            self.view.move(y - margin, x - margin)
+            self.draw()
+        elif not self.view.holds(y, x):
+            self.flush()
+            for strip in self.view.move(y - margin, x - margin):
+                self.paint(*strip)
+            self.snapshot()
+
+
+class FieldOfView():
+    """
+    Works out which tiles the player can see from a tile, using recursive
+    shadowcasting: walls block sight, everything else can be seen
+    through. Only tiles within the view radius are ever read, so the cost
+    of a field of view doesn't depend on the map size. The fields of view
+    of the last FOV_CACHE positions are kept.
+    """
+
+    # Row/column multipliers that turn the first octant into each of the 8
+    # octants around the player
+    OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, 1, -1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, -1, 1, 0), (1, 0, 0, -1)]
+
+    def __init__(self, map, radius=FOV_RADIUS, cache_size=FOV_CACHE):
+        self.map = map
+        self.radius = radius
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (row, col): visible tiles
+
+    def visible_from(self, row, col):
+        """
+        Tiles that can be seen from a tile
+        Args:
+            row (int): Viewer row
+            col (int): Viewer column
+        Returns:
+            visible (frozenset): (row, col) of every visible tile
+        """
+        visible = self.cache.get((row, col))
+        if visible is not None:
+            self.cache.move_to_end((row, col))
+            return visible
+
+        # Copy out just the tiles in range, anything off the map is wall
+        radius = self.radius
+        top, left = max(row - radius, 0), max(col - radius, 0)
+        bottom = min(row + radius, self.map.height - 1)
+        right = min(col + radius, self.map.width - 1)
+        walls = (np.array(self.map[top:bottom + 1, left:right + 1]) == 1)
+        walls = walls.tolist()
+
+        def blocks(tile_row, tile_col):
+            tile_row -= top
+            tile_col -= left
+            if not (0 <= tile_row < len(walls)
+                    and 0 <= tile_col < len(walls[0])):
+                return True
+            return walls[tile_row][tile_col]
+
+        tiles = {(row, col)}
+        for octant in self.OCTANTS:
+            self.cast(row, col, 1, 1.0, 0.0, octant, blocks, tiles)
+        visible = frozenset(tiles)
+
+        self.cache[(row, col)] = visible
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return visible
+
+    def cast(self, row, col, distance, start, end, octant, blocks, tiles):
+        """
+        Scans one octant outwards from "distance" tiles away, between the
+        "start" and "end" slopes, adding visible tiles to "tiles". Walls
+        split the scan, the part beyond a wall is scanned recursively
+        """
+        if start < end:
+            return
+        col_x, row_x, col_y, row_y = octant
+        radius = self.radius
+        next_start = start
+        for distance in range(distance, radius + 1):
+            blocked = False
+            dy = -distance
+            for dx in range(-distance, 1):
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+
+                tile_row = row + dx * row_x + dy * row_y
+                tile_col = col + dx * col_x + dy * col_y
+                if dx * dx + dy * dy <= radius * radius:
+                    tiles.add((tile_row, tile_col))
+
+                wall = blocks(tile_row, tile_col)
+                if blocked:
+                    if wall:
+                        next_start = right_slope
+                    else:
+                        blocked = False
+                        start = next_start
+                elif wall and distance < radius:
+                    # Scan what can be seen past this wall
+                    blocked = True
+                    self.cast(row, col, distance + 1, start, left_slope,
+                              octant, blocks, tiles)
+                    next_start = right_slope
+            if blocked:
+                break
+
+    def update(self, top, left, bottom, right):
+        """
+        Forgets the fields of view that could see an area of the map, call
+        after changing tiles in it
+        """
+        radius = self.radius
+        for row, col in list(self.cache):
+            if (top - radius <= row <= bottom + radius
+                    and left - radius <= col <= right + radius):
+                del self.cache[(row, col)]
+
+
+@telemetry.timed("smooth_map")
+def smooth_map(map: TileGrid, iterations=1):
     """
     Uses cellular automota algorithm to smooth the map and make it
     more "cave-like"
     Args:
-      map (list): Map 2D list
+      map (TileGrid): Map grid, smoothed in place
+      iterations (int): Number of smoothing passes
     Returns:
-      new_map (list): Map 2D list
+      map (TileGrid): Map grid
     """
-    new_map = [[1] * len(map[0]) for row in range(len(map))]
-    for row in range(len(map)):
-        for col in range(len(map[0])):
-            wall_neighbours = count_neighbours(map, row, col, 1)
-            if wall_neighbours >= 4:
-                new_map[row][col] = 1
-            elif wall_neighbours < 4:
-                new_map[row][col] = 0
+    map.smooth(iterations)
 
-    return new_map
+    return map
+
+
+def wall_neighbour_counts(tiles, walls=None, counts=None):
+    """
+    Counts the wall neighbours of every tile in one batched pass.
+    Equivalent to calling count_neighbours(map, row, col, 1) for each
+    tile: tiles outside the map count as wall
+    Args:
+      tiles (ndarray): 2D array of map tiles
+      walls (ndarray): Optional (height + 2) x (width + 2) scratch buffer
+                       whose outer ring is already set to 1
+      counts (ndarray): Optional height x width output buffer
+    Returns:
+      counts (ndarray): 2D array of wall neighbour counts, same shape
+                        as tiles
+    """
+    height, width = tiles.shape
+    if walls is None:
+        walls = np.ones((height + 2, width + 2), dtype=np.uint8)
+    if counts is None:
+        counts = np.empty((height, width), dtype=np.uint8)
+
+    # Ring of wall around the map so border tiles see the edge as wall
+    np.equal(tiles, 1, out=walls[1:-1, 1:-1], casting="unsafe")
+
+    counts.fill(0)
+    for row_offset in range(3):
+        for col_offset in range(3):
+            if row_offset == 1 and col_offset == 1:
+                continue  # Don't count the current tile
+            counts += walls[row_offset:row_offset + height,
+                            col_offset:col_offset + width]
+    return counts
+
+
+def smooth_map_parallel(map: TileGrid, iterations=1, workers=None,
+                        pool=None):
+    """
+    Same as smooth_map, but splits the map into horizontal bands and
+    smooths them in separate processes. Both tile buffers live in shared
+    memory: every pass each band reads its rows plus one halo row above
+    and below from one buffer and writes its rows to the other, then the
+    buffers swap. Gives exactly the same result as smooth_map.
+    Args:
+      map (TileGrid): Map grid, smoothed in place
+      iterations (int): Number of smoothing passes
+      workers (int): Number of processes, defaults to the CPU count
+      pool (ProcessPoolExecutor): Process pool to smooth in, for callers
+                                  smoothing many maps. One is started if
+                                  not given
+    Returns:
+      map (TileGrid): Map grid
+    """
+    workers = workers or os.cpu_count() or 1
+    height, width = map.height, map.width
+    workers = min(workers, height)
+
+    block = shared_memory.SharedMemory(create=True, size=2 * height * width)
+    try:
+        buffers = np.ndarray((2, height, width), dtype=np.uint8,
+                             buffer=block.buf)
+        buffers[0] = map.tiles
+
+        # Row ranges of each band
+        edges = [height * band // workers for band in range(workers + 1)]
+        bands = list(zip(edges[:-1], edges[1:]))
+
+        with contextlib.ExitStack() as stack:
+            if pool is None:
+                pool = stack.enter_context(ProcessPoolExecutor(workers))
+            for ind in range(iterations):
+                source = ind % 2
+                # Waiting for every band acts as the barrier between passes
+                list(pool.map(_smooth_band,
+                              [(block.name, height, width, source, start,
+                                end) for start, end in bands]))
+
+        map.tiles = buffers[iterations % 2].copy()
+        del buffers
+    finally:
+        block.close()
+        block.unlink()
+
+    return map
+
+
+def _smooth_band(task):
+    """
+    Runs one smoothing pass over rows start..end - 1 of the map held in
+    shared memory, see smooth_map_parallel. The block is attached for
+    the pass only, so a long lived worker doesn't keep old maps mapped
+    Args:
+      task (tuple): (shared memory name, height, width, source buffer
+                    index, start row, end row)
+    """
+    name, height, width, source, start, end = task
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buffers = np.ndarray((2, height, width), dtype=np.uint8,
+                             buffer=block.buf)
+
+        # The band plus one halo row either side, where the map has them.
+        # Rows past the map edge are counted as wall by
+        # wall_neighbour_counts
+        top = max(start - 1, 0)
+        bottom = min(end + 1, height)
+        counts = wall_neighbour_counts(buffers[source, top:bottom])
+        np.greater_equal(counts[start - top:end - top], 4,
+                         out=buffers[1 - source, start:end])
+        del buffers  # No views of the block may be left when it's closed
+    finally:
+        block.close()
+
+
+class NeighbourIndex():
+    """
+    Summed-area table of the wall tiles in a map, built once per map.
+    Answers "how many walls in this rectangle" and "how many wall
+    neighbours does this tile have" in O(1). Tiles in the one tile ring
+    outside the map count as wall, same as count_neighbours.
+    Rebuild it if walls are added or removed.
+    """
+
+    def __init__(self, map: TileGrid):
+        self.height = map.height
+        self.width = map.width
+        walls = np.pad(map.tiles == 1, 1, constant_values=True)
+        # table[i][j] is the number of walls in walls[:i, :j]
+        self.table = np.zeros((self.height + 3, self.width + 3),
+                              dtype=np.int32)
+        self.table[1:, 1:] = walls.cumsum(0).cumsum(1)
+
+    def walls_in(self, top, left, bottom, right):
+        """
+        Counts wall tiles in the rectangle top..bottom, left..right
+        (inclusive), clipped to the map and its outer wall ring
+        Args:
+            top (int): Top row
+            left (int): Left column
+            bottom (int): Bottom row
+            right (int): Right column
+        Returns:
+            count (int): Number of wall tiles in the rectangle
+        """
+        top = max(top, -1) + 1
+        left = max(left, -1) + 1
+        bottom = min(bottom, self.height) + 2
+        right = min(right, self.width) + 2
+        if top >= bottom or left >= right:
+            return 0
+
+        table = self.table
+        return int(table[bottom, right] - table[top, right]
+                   - table[bottom, left] + table[top, left])
+
+    def wall_neighbours(self, row, col):
+        """
+        Counts the wall tiles neighbouring map[row][col], same result as
+        count_neighbours(map, row, col, 1)
+        Args:
+            row (int): Tile row index
+            col (int): Tile column index
+        Returns:
+            count (int): Number of neighbouring wall tiles
+        """
+        return (self.walls_in(row - 1, col - 1, row + 1, col + 1)
+                - self.walls_in(row, col, row, col))
+
+    def all_wall_neighbours(self):
+        """
+        Wall neighbour counts for every tile of the map at once
+        Returns:
+            counts (ndarray): height x width array of wall neighbour counts
+        """
+        table = self.table
+        height, width = self.height, self.width
+        blocks = (table[3:, 3:] - table[:height, 3:]
+                  - table[3:, :width] + table[:height, :width])
+        centres = (table[2:-1, 2:-1] - table[1:-2, 2:-1]
+                   - table[2:-1, 1:-2] + table[1:-2, 1:-2])
+        return blocks - centres
 
 
 def count_neighbours(map, row, col, type):
@@ -96,7 +1271,7 @@ def count_neighbours(map, row, col, type):
       Counts number of tiles neighbouring map[row][col]
       of type "type" (wall or space)
       Args:
-        map (list): Map 2D list
+        map (TileGrid): Map grid
         row (int): Tile row index
         col (int): Tile column index
     type (int): 1 or 0, wall or space
@@ -114,9 +1289,9 @@ def count_neighbours(map, row, col, type):
                 # Only check neighbours of interior tiles
                 if (
                     neighbour_col >= 0
-                    and neighbour_col < len(map[0])
+                    and neighbour_col < map.width
                     and neighbour_row >= 0
-                    and neighbour_row < len(map)
+                    and neighbour_row < map.height
                 ):
                     if map[neighbour_row][neighbour_col] == type:
                         count += 1
@@ -129,52 +1304,81 @@ def spawn_bear(map, x_limit):
     """
     Spawns a bear for the player to interact with
     Args:
-        map (list): Map 2D list
+        map (TileGrid): Map grid
         x_limit (int): X coord limit for spawn location
     Returns:
-        Returns:
-        map (2D list): The 2D list containing the map
+        map (TileGrid): Map grid
     """
-    map[BEAR_Y][BEAR_X] = 2
+    map[BEAR_Y, BEAR_X] = 2
     # Bear emoji width is 2 units, set adjacent cells to 4 to prevent
     # player/bear overlap
-    map[BEAR_Y][BEAR_X + 1] = 4
-    map[BEAR_Y][BEAR_X - 1] = 4
+    map[BEAR_Y, BEAR_X + 1] = 4
+    map[BEAR_Y, BEAR_X - 1] = 4
 
     return map
 
 
-def spawn_goldilocks(map: list[list[int]]):
+def place_bear(rng: random.Random | None = None):
+    """
+    Picks new bear spawn coordinates
+    Args:
+        rng (random.Random): Random number generator, the random module
+                             if None
+    """
+    global BEAR_X, BEAR_Y
+    randrange = random.randrange if rng is None else rng.randrange
+    BEAR_X = randrange(200, 240)
+    BEAR_Y = randrange(5, 65)
+
+
+def spawn_goldilocks(map: "TileGrid | MapOverlay | ChunkManager"):
     """
     Sets Golidlocks and Porridge area of map to open space
     Args:
-        map (2D list): The 2D list containing the map
+        map (TileGrid, MapOverlay or ChunkManager): Map grid
     Returns:
-        map (2D list): The 2D list containing the map
+        map (TileGrid, MapOverlay or ChunkManager): Map grid
     """
     # reserve open space for goldilocks
     for y in range(GOLDILOCKS_Y - 2, GOLDILOCKS_Y + 1):
         for x in range(GOLDILOCKS_X, GOLDILOCKS_X + 2):
-            map[y][x] = 0
+            change_tile(map, y, x, 0)
 
     return map
 
 
+def change_tile(map, row, col, tile):
+    """
+    Changes a map tile during a game, and logs the change in the session's
+    edits so a saved game can make it again
+    Args:
+        map (TileGrid): Map grid
+        row (int): Tile row
+        col (int): Tile column
+        tile (int): New tile
+    """
+    map[row, col] = tile
+    current_session().edits[(row, col)] = tile
+
+
 def inventory():
     """
         Initialises new window below main pad to display player
         inventory
     Returns:
-        inv (dict): Dict containing items with key: inventory item,
+        inv (dict): The session's inventory, with key: inventory item,
                     and value: item quantity
     """
-    global inv_win
-    inv_win = c.newwin(1, 40, 23, 0)
+    session = current_session()
+    inv_win = session.inv_win = c.newwin(1, 40, 23, 0)
     inv_win.nodelay(True)
     inv_win.addstr("Inventory:")
-    inv_win.refresh()
+    inv = session.inventory
+    for index, item in enumerate(inv):
+        if inv[item] > 0:
+            inv_win.addstr(0, 11 + index * 10, f"{item}: {inv[item]}")
+    frame.update(inv_win)
     inv_win.getch()
-    inv = {"Rock": 0, "Porridge": 0}
     return inv
 
 
@@ -188,26 +1392,32 @@ def update_inventory(item: str, inv: dict):
     Returns:
         _type_: _description_
     """
+    inv_win = current_session().inv_win
     new_inventory = inv[item] + 1
     inv.update({item: new_inventory})
     for index, item in enumerate(inv):
         if inv[item] > 0:
             inv_win.addstr(0, 11 + index * 10, f"{item}: {inv[item]}")
-    inv_win.refresh()
+    frame.update(inv_win)
     return inv
 
 
 def coords(x: int, y: int):
     """
-        Generates and updates coordinate window to keep track of
-        player position
+        Updates coordinate window to keep track of player position.
+        The window is created on the first call, and shown on the next
+        frame.show()
     Args:
         x (int): Player X coordinate
         y (int): Player Y coordinate
     """
-    coords_win = c.newwin(1, 19, 23, 41)
+    session = current_session()
+    if session.coords_win is None:
+        session.coords_win = c.newwin(1, 19, 23, 41)
+    coords_win = session.coords_win
+    coords_win.erase()
     coords_win.addstr(0, 1, f"x:{x}, y:{y}")
-    coords_win.refresh()
+    frame.update(coords_win)
 
 
 def show_inventory(inv: dict):
@@ -235,14 +1445,29 @@ def pause_menu():
     pause_win.border(0, 0, 0, 0, 0, 0, 0, 0)
     pause_win.addstr(2, 24, "GAME PAUSED")
 
-    pause_win.refresh()
     pause_win.keypad(True)
-    pause_win.nodelay(True)
     options = ["Resume", "Help", "Exit"]
     highlight = 0
     key = 0
 
     while True:
+        # Print and highlight selected option
+        for index, option in enumerate(options):
+            if index == highlight:
+                pause_win.attron(c.A_REVERSE)
+                pause_win.addstr(6 + 3 * index, int(30 - len(option) / 2),
+                                 f"{option}")
+
+                pause_win.attroff(c.A_REVERSE)
+            else:
+                # Add strings roughly in the center of the window
+                pause_win.addstr(6 + 3 * index, int(30 - len(option) / 2),
+                                 f"{option}")
+
+        frame.update(pause_win)
+        frame.show()
+
+        # Wait for a key press
         key = pause_win.getch()
         if key == ESC:
             break
@@ -268,21 +1493,6 @@ def pause_menu():
                     print("Thanks for playing!")
                     break
 
-        # Print and highlight selected option
-        for index, option in enumerate(options):
-            if index == highlight:
-                pause_win.attron(c.A_REVERSE)
-                pause_win.addstr(6 + 3 * index, int(30 - len(option) / 2),
-                                 f"{option}")
-
-                pause_win.attroff(c.A_REVERSE)
-            else:
-                # Add strings roughly in the center of the window
-                pause_win.addstr(6 + 3 * index, int(30 - len(option) / 2),
-                                 f"{option}")
-
-        pause_win.refresh()
-
 
 def help_menu():
     """ Displays Help Menu information window """
@@ -296,8 +1506,8 @@ def help_menu():
         "• Walk around using the arrow keys or wasd",
         "• Interact using 'E'",
         "• Access inventory using 'I'",
-        "• Explore the map, if you get stuck",
-        "  or reach a dead end, try reloading the game",
+        "• Explore the cave, the bear and Goldilocks",
+        "  can always be reached from the start",
         "• Press any key to go back",
     ]
 
@@ -456,6 +1666,8 @@ def goldilocks_dialogue():
 class Projectile():
     """ Class for spawning and updating projectiles for minigame """
 
+    __slots__ = ("y", "x", "speed", "active")
+
     def __init__(self, y, x, speed):
         self.y = y
         self.x = x
@@ -470,6 +1682,339 @@ class Projectile():
         self.active = False
 
 
+class ProjectileManager():
+    """
+    Keeps the live projectiles of the fight minigame. Projectiles that
+    leave the fight area are swapped out of the live list in O(1) and
+    kept on a free list for the next spawn, and live projectiles are
+    indexed by column every tick so hit tests only look at projectiles
+    in the target's columns.
+    """
+
+    def __init__(self, top=2, bottom=15):
+        self.top = top  # Projectiles above this row are removed
+        self.bottom = bottom  # Projectiles below this row are removed
+        self.live = []
+        self.free = []  # Deactivated projectiles, reused by spawn()
+        self.columns = {}  # x: live projectiles in that column
+
+    def __len__(self):
+        return len(self.live)
+
+    def __iter__(self):
+        return iter(self.live)
+
+    def positions(self):
+        """
+        Returns:
+            positions (list): (y, x, speed) of every live projectile
+        """
+        return [(projectile.y, projectile.x, projectile.speed)
+                for projectile in self.live]
+
+    def spawn(self, y, x, speed):
+        """
+        Fires a new projectile, reusing a deactivated one if possible.
+        Moves and counts for hits from the next update()
+        Args:
+            y (int): Starting row
+            x (int): Column
+            speed (int): Rows moved per tick (negative moves up)
+        """
+        if self.free:
+            projectile = self.free.pop()
+            projectile.y, projectile.x, projectile.speed = y, x, speed
+            projectile.active = True
+        else:
+            projectile = Projectile(y, x, speed)
+        self.live.append(projectile)
+        return projectile
+
+    def update(self):
+        """
+        Moves every live projectile one tick, removes the ones that were
+        already at the edge of the fight area, and rebuilds the column
+        index
+        """
+        live = self.live
+        columns = {}
+        index = 0
+        while index < len(live):
+            projectile = live[index]
+            # prevent projectiles updating outside of the fight window
+            if projectile.y > self.bottom or projectile.y < self.top:
+                projectile.deactivate()
+                self.free.append(projectile)
+                # Swap with the last projectile instead of shifting the list
+                live[index] = live[-1]
+                live.pop()
+                continue
+
+            projectile.update_position()
+            columns.setdefault(projectile.x, []).append(projectile)
+            index += 1
+        self.columns = columns
+
+    def hits(self, y, x, width=1):
+        """
+        Counts live projectiles at row y, columns x to x + width - 1, as
+        of the last update()
+        Args:
+            y (int): Target row
+            x (int): Target left column
+            width (int): Target width in columns
+        Returns:
+            count (int): Number of projectiles hitting the target
+        """
+        count = 0
+        for col in range(x, x + width):
+            for projectile in self.columns.get(col, ()):
+                if projectile.y == y:
+                    count += 1
+        return count
+
+
+class ProjectileArrays():
+    """
+    Same as ProjectileManager, but stores projectile rows, columns and
+    speeds in parallel NumPy arrays so a tick is a few array operations
+    however many projectiles are live. Live projectiles are kept packed
+    in the first len(self) slots, so a slot is active if its index is
+    below len(self).
+    """
+
+    def __init__(self, top=2, bottom=15, capacity=64):
+        self.top = top  # Projectiles above this row are removed
+        self.bottom = bottom  # Projectiles below this row are removed
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.speed = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (Projectile(*position) for position in self.positions())
+
+    def positions(self):
+        """
+        Returns:
+            positions (list): (y, x, speed) of every live projectile
+        """
+        n = self.count
+        return list(zip(self.y[:n].tolist(), self.x[:n].tolist(),
+                        self.speed[:n].tolist()))
+
+    def spawn(self, y, x, speed):
+        """
+        Fires a new projectile, growing the arrays if they are full.
+        Moves and counts for hits from the next update()
+        Args:
+            y (int): Starting row
+            x (int): Column
+            speed (int): Rows moved per tick (negative moves up)
+        """
+        if self.count == len(self.y):
+            capacity = len(self.y) * 2
+            self.y = np.resize(self.y, capacity)
+            self.x = np.resize(self.x, capacity)
+            self.speed = np.resize(self.speed, capacity)
+        self.y[self.count] = y
+        self.x[self.count] = x
+        self.speed[self.count] = speed
+        self.count += 1
+
+    def update(self):
+        """
+        Moves every live projectile one tick and removes the ones that
+        were already at the edge of the fight area
+        """
+        n = self.count
+        y = self.y[:n]
+        keep = (y >= self.top) & (y <= self.bottom)
+        kept = int(np.count_nonzero(keep))
+        if kept < n:
+            # Pack the remaining projectiles into the front of the arrays
+            self.y[:kept] = y[keep]
+            self.x[:kept] = self.x[:n][keep]
+            self.speed[:kept] = self.speed[:n][keep]
+            self.count = kept
+        self.y[:kept] += self.speed[:kept]
+
+    def hits(self, y, x, width=1):
+        """
+        Counts live projectiles at row y, columns x to x + width - 1, as
+        of the last update()
+        Args:
+            y (int): Target row
+            x (int): Target left column
+            width (int): Target width in columns
+        Returns:
+            count (int): Number of projectiles hitting the target
+        """
+        n = self.count
+        cols = self.x[:n]
+        return int(np.count_nonzero(
+            (self.y[:n] == y) & (cols >= x) & (cols < x + width)))
+
+
+PROJECTILE_BACKENDS = {
+    "objects": ProjectileManager,
+    "arrays": ProjectileArrays,
+}
+
+
+class Fight():
+    """
+    Goldilocks, the player and the projectiles of the fight minigame, and
+    where they were drawn last frame. fight_goldilocks runs the loop and
+    calls tick() every 1/fps seconds, move_player() with every key and
+    draw() every frame
+    """
+
+    def __init__(self, fight_win, projectiles=None):
+        """
+        Args:
+            fight_win (window): Fight window to draw on
+            projectiles: Live projectiles, an empty PROJECTILE_BACKEND
+                         store if None
+        """
+        self.fight_win = fight_win
+        self.win = False
+        self.defeat = False
+
+        # GOLDILOCKS INITIAL POSITION
+        self.goldilocks_x = 1
+        self.goldilocks_y = 1
+        self.goldilocks_health = 3
+        self.goldilocks_hearts = "GOLDILOCKS: ❤ ❤ ❤"
+        self.goldilocks_direction = -1  # initial direction for movement
+        # Number of iteretions since last projectile fired, to not
+        # overwhelm player with projectiles
+        self.goldilocks_cooldown = 0
+
+        # PLAYER INITIAL POSITION
+        self.player_x = 30
+        self.player_y = 16
+        # Cooldown for player projectile, to prevent rapidfire
+        self.player_cooldown = 0
+
+        if projectiles is None:
+            projectiles = PROJECTILE_BACKENDS[PROJECTILE_BACKEND]()
+        self.projectiles = projectiles
+
+        # Positions drawn last frame, so they can be erased
+        self.drawn_goldilocks_x = self.goldilocks_x
+        self.drawn_player_x = self.player_x
+        self.drawn_projectiles = []
+
+    def tick(self):
+        """
+        Moves Goldilocks and the projectiles one step, lets Goldilocks
+        fire and checks for hits
+        """
+        fight_win = self.fight_win
+        projectiles = self.projectiles
+
+        # Goldilocks Movement
+        # Left / right boundaries
+        if self.goldilocks_x == 57 or self.goldilocks_x == 1:
+            self.goldilocks_direction *= -1
+        self.goldilocks_x += self.goldilocks_direction
+
+        # Fire projectile semi-randomly
+        if ((random.randrange(100) > 70 and self.goldilocks_cooldown > 5) or
+                self.goldilocks_x == self.player_x):
+
+            projectiles.spawn(self.goldilocks_y + 1, self.goldilocks_x, 1)
+            self.goldilocks_cooldown = 0
+
+        # Projectile movement
+        projectiles.update()
+
+        # Goldilocks hit detection (Goldilocks emoji is 2 columns wide):
+        hits = projectiles.hits(self.goldilocks_y, self.goldilocks_x, 2)
+        if hits:
+            # Decrease Health and Hearts
+            self.goldilocks_health = max(self.goldilocks_health - hits, 0)
+
+            if self.goldilocks_health == 2:
+                self.goldilocks_hearts = "GOLDILOCKS: ❤ ❤  "
+
+            if self.goldilocks_health == 1:
+                self.goldilocks_hearts = "GOLDILOCKS: ❤    "
+
+            if self.goldilocks_health == 0:
+                self.goldilocks_hearts = "GOLDILOCKS:      "
+                self.win = True
+
+            fight_win.addstr(0, 21, f"{self.goldilocks_hearts}")
+
+        # Player hit detection:
+        if projectiles.hits(self.player_y, self.player_x):
+            fight_win.addstr(17, 25, "PLAYER:  ")
+            self.defeat = True
+
+        self.goldilocks_cooldown += 1  # Prevent rapid fire
+        self.player_cooldown += 1  # Prevent rapid fire
+
+    def move_player(self, key):
+        """
+        Moves the player or fires for a key press
+        Args:
+            key (int): Key pressed, -1 if none
+        """
+        # move left
+        if key == c.KEY_LEFT or key == ord("a") or key == ord("A"):
+            if self.player_x != 2:
+                self.player_x -= 1
+
+        # move right
+        if key == c.KEY_RIGHT or key == ord("d") or key == ord("D"):
+            if self.player_x != 58:
+                self.player_x += 1
+
+        # fire projectile
+        if key == ord(" ") and self.player_cooldown > 5:
+
+            # Spawn player projectile (note negative speed)
+            self.projectiles.spawn(self.player_y - 1, self.player_x, -1)
+            self.player_cooldown = 0
+
+    def draw(self, ticked):
+        """
+        Erases last frame's positions, then draws this frame's.
+        Goldilocks and projectiles only change on a tick
+        Args:
+            ticked (bool): Whether tick() ran this frame
+        """
+        fight_win = self.fight_win
+        if ticked:
+            fight_win.addstr(self.goldilocks_y, self.drawn_goldilocks_x, "  ")
+            self.drawn_goldilocks_x = self.goldilocks_x
+            fight_win.addstr(self.goldilocks_y, self.goldilocks_x, "👧")
+
+            for y, x in self.drawn_projectiles:
+                fight_win.addstr(y, x, " ")
+            drawn_projectiles = []
+            for y, x, speed in self.projectiles.positions():
+                # Different projectiles for goldilocks and player
+                if speed == 1:
+                    # Goldilocks projectile
+                    fight_win.addstr(y, x, "|")
+                else:
+                    # Player projectile
+                    fight_win.addstr(y, x, "•")
+                drawn_projectiles.append((y, x))
+            self.drawn_projectiles = drawn_projectiles
+
+        if self.player_x != self.drawn_player_x:
+            fight_win.addstr(self.player_y, self.drawn_player_x, " ")
+            self.drawn_player_x = self.player_x
+        fight_win.addstr(self.player_y, self.player_x, f"{PLAYER_ICON}")
+
+
 def fight_goldilocks():
     """
         Generates window and logic for bullet dodge style minigame
@@ -499,136 +2044,47 @@ def fight_goldilocks():
     fight_win.clear()
     fight_win.border()
 
-    win = False
-    defeat = False
-
-    # GOLDILOCKS INITIAL POSITION
-    goldilocks_x = 1
-    goldilocks_y = 1
-    goldilocks_health = 3
-    goldilocks_hearts = "GOLDILOCKS: ❤ ❤ ❤"
-    fight_win.addstr(0, 21, f"{goldilocks_hearts}")
-
-    # PLAYER INITIAL POSITION
-    player_x = 30
-    player_y = 16
+    fight = Fight(fight_win)
+    fight_win.addstr(0, 21, f"{fight.goldilocks_hearts}")
     fight_win.addstr(17, 25, "PLAYER: ❤")
 
-    fight_win.nodelay(True)
-
     fps = 10  # frames per second for goldilocks and projectile movement
-    goldilocks_direction = -1  # initial direction for goldilocks movement
-    player_cooldown = 0  # Cooldown for player projectile, to prevent rapidfire
-    projectiles = []
+    tick_length = 1 / fps
     key = 0
 
     # Main movement:
-    goldilocks_cooldown = 0  # Number of iteretions since last projectile
-    # fired, to not overwhelm player with projectiles
-    time_of_last = time.time()  # Time of last goldilocks movement iteration
-
-    while not win and not defeat:
-
-        # Only move Goldilocks and projectiles every 1/fps seconds
-        if time.time() - time_of_last > 1 / fps:
-
-            # Goldilocks Movement
-            fight_win.addstr(goldilocks_y, goldilocks_x, "  ")
-
-            # Left / right boundaries
-            if goldilocks_x == 57 or goldilocks_x == 1:
-                goldilocks_direction *= -1
-            goldilocks_x += goldilocks_direction
-            fight_win.addstr(goldilocks_y, goldilocks_x, "👧")
-
-            # Fire projectile semi-randomly
-            if ((random.randrange(100) > 70 and goldilocks_cooldown > 5) or
-                    goldilocks_x == player_x):
-
-                projectiles.append(Projectile(goldilocks_y + 1,
-                                   goldilocks_x, 1))
-                goldilocks_cooldown = 0
+    next_tick = clock.monotonic() + tick_length  # Next goldilocks movement
 
-            # Projectile movement
-            for projectile in projectiles:
-                fight_win.addstr(projectile.y, projectile.x, " ")
-
-                # prevent projectiles updating outside of the fight window
-                if projectile.y > 15 or projectile.y < 2:
-                    projectile.deactivate()
-                    projectiles.remove(projectile)
-
-                else:
-                    projectile.update_position()
-
-                    # Different projectiles for goldilocks and player
-                    if projectile.speed == 1:
-                        # Goldilocks projectile
-                        fight_win.addstr(projectile.y, projectile.x, "|")
-                    else:
-                        # Player projectile
-                        fight_win.addstr(projectile.y, projectile.x, "•")
-
-                # Goldilocks hit detection:
-                if (projectile.y == goldilocks_y and
-                   (projectile.x == goldilocks_x or
-                        projectile.x == goldilocks_x + 1)):
-
-                    # Decrease Health and Hearts
-                    goldilocks_health -= 1
-
-                    if goldilocks_health == 2:
-                        goldilocks_hearts = "GOLDILOCKS: ❤ ❤  "
-
-                    if goldilocks_health == 1:
-                        goldilocks_hearts = "GOLDILOCKS: ❤    "
-
-                    if goldilocks_health == 0:
-                        goldilocks_hearts = "GOLDILOCKS:      "
-                        win = True
-
-                    fight_win.addstr(0, 21, f"{goldilocks_hearts}")
-
-                # Player hit detection:
-                if projectile.y == player_y and projectile.x == player_x:
-                    fight_win.addstr(17, 25, "PLAYER:  ")
-                    defeat = True
-
-            goldilocks_cooldown += 1  # Prevent rapid fire
-            player_cooldown += 1  # Prevent rapid fire
-            time_of_last = time.time()
+    while not fight.win and not fight.defeat:
 
+        # Wait for a key press, but only until the next tick is due, so the
+        # loop sleeps instead of polling
+        wait = math.ceil((next_tick - clock.monotonic()) * 1000)
+        fight_win.timeout(max(wait, 0))
         key = fight_win.getch()
-
-        # Player movement
-
-        # move left
-        if key == c.KEY_LEFT or key == ord("a") or key == ord("A"):
-            if player_x != 2:
-                fight_win.addstr(player_y, player_x, " ")
-                player_x -= 1
-
-        # move right
-        if key == c.KEY_RIGHT or key == ord("d") or key == ord("D"):
-            if player_x != 58:
-                fight_win.addstr(player_y, player_x, " ")
-                player_x += 1
-
-        # fire projectile
-        if key == ord(" ") and player_cooldown > 5:
-
-            # Spawn player projectile (note negative speed)
-            projectiles.append(Projectile(player_y - 1, player_x, -1))
-            player_cooldown = 0
-
-        fight_win.addstr(player_y, player_x, f"{PLAYER_ICON}")
-
-        fight_win.refresh()
-
-        if win:
+        started = telemetry.now()
+
+        # Tick: only move Goldilocks and projectiles every 1/fps seconds
+        now = clock.monotonic()
+        ticked = now >= next_tick
+        if ticked:
+            next_tick += tick_length
+            # Don't try to catch up on ticks missed during a long stall
+            if next_tick < now:
+                next_tick = now + tick_length
+            fight.tick()
+
+        fight.move_player(key)
+        fight.draw(ticked)
+
+        frame.update(fight_win)
+        frame.show()
+        telemetry.record("fight_tick" if ticked else "fight_frame", started)
+
+        if fight.win:
             fight_win.nodelay(False)
             c.flash()
-            time.sleep(0.2)
+            clock.sleep(0.2)
             c.flash()
             win_win = fight_win.derwin(7, 32, 5, 14)
             win_win.border()
@@ -643,10 +2099,10 @@ def fight_goldilocks():
             return True  # Continue game
             break
 
-        if defeat:
+        if fight.defeat:
             fight_win.nodelay(False)
             c.flash()
-            time.sleep(0.2)
+            clock.sleep(0.2)
             c.flash()
             defeat_win = fight_win.derwin(7, 32, 5, 14)
             defeat_win.border()
@@ -662,15 +2118,23 @@ def fight_goldilocks():
             break
 
 
-def update_quest(quest: bool, quest_complete: bool):
+def update_quest(quest: bool, quest_complete: bool,
+                 steps: int | None = None):
     """
-    Updates and displays current quest in quest window
+    Updates current quest in quest window. The window is created on the
+    first call, and shown on the next frame.show()
 
     Args:
         quest (bool): Bool indicating whether a quest has started
         quest_complete (bool): Bool indicating quest completed
+        steps (int): Steps to the next quest goal, shown as a hint.
+                     Not shown if None
     """
-    quest_win = c.newwin(11, 19, 0, 61)
+    session = current_session()
+    if session.quest_win is None:
+        session.quest_win = c.newwin(11, 19, 0, 61)
+    quest_win = session.quest_win
+    quest_win.erase()
     quest_win.border()
 
     quest_win.addstr(0, 5, " QUESTS ")
@@ -681,19 +2145,30 @@ def update_quest(quest: bool, quest_complete: bool):
         quest_win.addstr(5, 1, "  Goldilocks,")
         quest_win.addstr(6, 1, "  and take it to")
         quest_win.addstr(7, 1, "  🐻")
+        if steps is not None:
+            quest_win.addstr(9, 1, f"  {steps} steps away")
 
     elif quest_complete:
         quest_win.addstr(3, 1, "• All")
         quest_win.addstr(4, 1, "  quests")
         quest_win.addstr(5, 1, "  complete")
 
-    quest_win.refresh()
+    frame.update(quest_win)
 
 
 def controls():
-    """ Generates window to display controls for game. """
-
-    controls_win = c.newwin(10, 19, 11, 61)
+    """
+    Generates window to display controls for game. Later calls redraw it
+    (e.g. after another window covered it) on the next frame.show()
+    """
+    session = current_session()
+    controls_win = session.controls_win
+    if controls_win is not None:
+        controls_win.touchwin()
+        frame.update(controls_win)
+        return
+
+    controls_win = session.controls_win = c.newwin(10, 19, 11, 61)
     controls_win.border()
 
     controls = [
@@ -709,31 +2184,1533 @@ def controls():
     for index, string in enumerate(controls):
         controls_win.addstr(2 + index * 2, 1, string)
 
-    controls_win.refresh()
+    frame.update(controls_win)
 
 
-def spawn_rock(map: list[list[int]]):
+@telemetry.timed("spawn_rock")
+def spawn_rock(map: TileGrid, neighbours: NeighbourIndex | None = None,
+               rng: random.Random | None = None):
     """
     Spawns rocks in locations around the map
     Args:
-        map (list): 2D list containing the map
-    """
-    # Count neighbour tiles
-    for row in range(len(map)):
-        for col in range(len(map[0])):
-            if map[row][col] == 0:
-                wall_neighbours = count_neighbours(map, row, col, 1)
-                # for spawning rocks in nooks and crannies
-                if wall_neighbours >= 5 and wall_neighbours <= 6:
-                    # rock rarity
-                    if random.random() < 0.05:
-                        map[row][col] = 3
+        map (TileGrid): Map grid
+        neighbours (NeighbourIndex): Wall index for map, built if not given
+        rng (random.Random): Random number generator used to place rocks,
+                             the random module if None
+    """
+    chance = random.random if rng is None else rng.random
+    if neighbours is None:
+        neighbours = NeighbourIndex(map)
+
+    # for spawning rocks in nooks and crannies: open tiles with 5 or 6
+    # wall neighbours. Rocks aren't walls, so placing one doesn't change
+    # the counts of the tiles after it
+    wall_neighbours = neighbours.all_wall_neighbours()
+    nooks = ((map.tiles == 0) & (wall_neighbours >= 5)
+             & (wall_neighbours <= 6))
+    for row, col in np.argwhere(nooks):
+        # rock rarity
+        if chance() < 0.05:
+            map[row, col] = 3
+    return map
+
+
+def label_regions(open_tiles):
+    """
+    Labels the connected regions of open tiles. Tiles are connected to
+    the tiles above, below, left and right of them, the same moves the
+    player can make
+    Args:
+        open_tiles (ndarray): Boolean array, True where the player can walk
+    Returns:
+        labels (ndarray): Same shape int array. Tiles in the same region
+                          share a label, closed tiles are -1
+    """
+    height, width = open_tiles.shape
+    index = np.arange(height * width).reshape(height, width)
+    parent = index.ravel().copy()
+
+    # Every pair of open tiles next to each other
+    across = open_tiles[:, :-1] & open_tiles[:, 1:]
+    down = open_tiles[:-1] & open_tiles[1:]
+    first = np.concatenate((index[:, :-1][across], index[:-1][down]))
+    second = np.concatenate((index[:, 1:][across], index[1:][down]))
+
+    # Union-find on arrays: join the roots of every pair not yet in the
+    # same region to the lower root, then point every tile straight at its
+    # root. Joined pairs stay joined, so they are dropped as we go
+    while True:
+        first_root = parent[first]
+        second_root = parent[second]
+        apart = first_root != second_root
+        if not apart.any():
+            break
+        first, second = first[apart], second[apart]
+        first_root, second_root = first_root[apart], second_root[apart]
+        np.minimum.at(parent, np.maximum(first_root, second_root),
+                      np.minimum(first_root, second_root))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    return np.where(open_tiles, parent.reshape(height, width), -1)
+
+
+def dig_tunnel(tiles, open_tiles, reached, goal):
+    """
+    Finds the path from the reached tiles to a goal tile that goes
+    through the fewest walls. The bear and the tiles around the edge of
+    the map are never dug through
+    Args:
+        tiles (ndarray): Map tiles
+        open_tiles (ndarray): Boolean array, True where the player can walk
+        reached (ndarray): Boolean array of tiles the path can start from
+        goal (ndarray): Boolean array of tiles the path can end on
+    Returns:
+        path (list): (row, col) of every tile on the path, [] if there is
+                     no path
+    """
+    height, width = tiles.shape
+    blocked = (tiles == 2) | (tiles == 4)
+    blocked[0] = blocked[-1] = True
+    blocked[:, 0] = blocked[:, -1] = True
+    walls = ~open_tiles
+    walls_passed = np.full(height * width, height * width, dtype=np.int32)
+    came_from = np.full(height * width, -1, dtype=np.int32)
+
+    # 0-1 breadth first search: stepping onto open ground is free and
+    # digging through a wall costs 1, so the tunnel is as short as it can be
+    queue = deque()
+    for cell in np.flatnonzero(reached).tolist():
+        walls_passed[cell] = 0
+        queue.append(cell)
+    blocked = blocked.ravel().tolist()
+    walls = walls.ravel().tolist()
+    goal = goal.ravel().tolist()
+    while queue:
+        cell = queue.popleft()
+        if goal[cell]:
+            path = []
+            while cell != -1:
+                path.append(divmod(cell, width))
+                cell = int(came_from[cell])
+            return path[::-1]
+        row, col = divmod(cell, width)
+        for step in (-width, width, -1, 1):
+            if (step == -1 and col == 0) or (step == 1 and col == width - 1):
+                continue
+            neighbour = cell + step
+            if neighbour < 0 or neighbour >= height * width:
+                continue
+            if blocked[neighbour]:
+                continue
+            cost = walls_passed[cell] + walls[neighbour]
+            if cost < walls_passed[neighbour]:
+                walls_passed[neighbour] = cost
+                came_from[neighbour] = cell
+                if walls[neighbour]:
+                    queue.append(neighbour)
+                else:
+                    queue.appendleft(neighbour)
+    return []
+
+
+@telemetry.timed("connect_map")
+def connect_map(map, height=ROWS, width=COLS):
+    """
+    Makes sure the bear and Goldilocks can be reached from the player's
+    start by digging tunnels through the fewest walls needed. Maps where
+    everything is already reachable aren't changed
+    Args:
+        map (TileGrid or ChunkManager): Map with the bear spawned
+        height (int): Rows of the map to check
+        width (int): Columns of the map to check
+    Returns:
+        map (TileGrid or ChunkManager): Map grid
+    """
+    tiles = np.array(map[0:height, 0:width])
+    start = (24, 40)  # player start
+    if tiles[start] == 1:
+        map[start] = 0
+        tiles[start] = 0
+    open_tiles = (tiles == 0) | (tiles == 3)
+
+    # Areas the player has to reach, tiles the player talks to the bear
+    # and Goldilocks from. The bear has to be reached before Goldilocks'
+    # area is opened up by the quest
+    targets = [
+        ((BEAR_Y - 1, BEAR_X - 2, BEAR_Y + 1, BEAR_X + 2), None),
+        ((GOLDILOCKS_Y - 2, GOLDILOCKS_X, GOLDILOCKS_Y, GOLDILOCKS_X + 1),
+         (GOLDILOCKS_Y - 2, GOLDILOCKS_X, GOLDILOCKS_Y, GOLDILOCKS_X + 1)),
+    ]
+    for area, opened in targets:
+        if opened is not None:
+            top, left, bottom, right = opened
+            open_tiles[top:bottom + 1, left:right + 1] = True
+
+        labels = label_regions(open_tiles)
+        reached = labels == labels[start]
+        top, left, bottom, right = area
+        goal = np.zeros_like(open_tiles)
+        goal[top:bottom + 1, left:right + 1] = True
+        goal &= (tiles != 2) & (tiles != 4)
+        if (reached & goal).any():
+            continue
+
+        for row, col in dig_tunnel(tiles, open_tiles, reached, goal):
+            if not open_tiles[row, col]:
+                map[row, col] = 0
+                tiles[row, col] = 0
+                open_tiles[row, col] = True
     return map
 
 
-def main(stdscr):
+def quest_areas():
+    """
+    Areas the player has to reach for the quest: next to the bear, next to
+    Goldilocks, and the porridge
+    Returns:
+        areas (dict): name: (top, left, bottom, right) area, inclusive
+    """
+    return {
+        "bear": (BEAR_Y - 1, BEAR_X - 2, BEAR_Y + 1, BEAR_X + 2),
+        "goldilocks": (PORRIDGE_Y - 1, GOLDILOCKS_X - 1,
+                       GOLDILOCKS_Y + 1, GOLDILOCKS_X + 2),
+        "porridge": (PORRIDGE_Y, PORRIDGE_X, PORRIDGE_Y, PORRIDGE_X),
+    }
+
+
+class PathFinder():
+    """
+    Walking distances and routes over the map, using the same moves and
+    blocking tiles as the player. Distance fields (steps from every tile
+    to the nearest tile of a target area) are built the first time a
+    target is asked for and kept, so distance() is a single array lookup.
+    Call update() after changing tiles of the map.
+    Only the top left height x width tiles of the map are searched.
+    """
+
+    def __init__(self, map, height=ROWS, width=COLS, targets=None):
+        self.map = map
+        self.height = height
+        self.width = width
+        self.walkable = self.walkable_tiles(np.array(map[0:height, 0:width]))
+        self.targets = quest_areas() if targets is None else dict(targets)
+        self.fields = {}  # target name: distance field, -1 is unreachable
+
+    @staticmethod
+    def walkable_tiles(tiles):
+        """ True where the player can walk: not wall, bear or bear adjacent """
+        return (tiles != 1) & (tiles != 2) & (tiles != 4)
+
+    def inside(self, row, col):
+        return 0 <= row < self.height and 0 <= col < self.width
+
+    def neighbours(self, row, col):
+        """ Walkable tiles above, below, left and right of a tile """
+        for next_row, next_col in ((row - 1, col), (row + 1, col),
+                                   (row, col - 1), (row, col + 1)):
+            if (self.inside(next_row, next_col)
+                    and self.walkable[next_row, next_col]):
+                yield next_row, next_col
+
+    def goal(self, name):
+        """ Boolean array of the walkable tiles in a target area """
+        top, left, bottom, right = self.targets[name]
+        goal = np.zeros_like(self.walkable)
+        goal[max(top, 0):bottom + 1, max(left, 0):right + 1] = True
+        return goal & self.walkable
+
+    def field(self, name):
+        """
+        Distance field for a target, built with a breadth first search out
+        from the target area if it isn't cached
+        Args:
+            name (str): Target name
+        Returns:
+            field (ndarray): Steps to the target from each tile, -1 if the
+                             target can't be reached from the tile
+        """
+        field = self.fields.get(name)
+        if field is not None:
+            return field
+
+        width = self.width
+        walkable = self.walkable.ravel().tolist()
+        distances = [-1] * (self.height * width)
+        queue = deque(np.flatnonzero(self.goal(name)).tolist())
+        for cell in queue:
+            distances[cell] = 0
+        while queue:
+            cell = queue.popleft()
+            steps = distances[cell] + 1
+            col = cell % width
+            for neighbour in (cell - width, cell + width,
+                              cell - 1 if col > 0 else -1,
+                              cell + 1 if col < width - 1 else -1):
+                if (0 <= neighbour < len(distances) and walkable[neighbour]
+                        and distances[neighbour] == -1):
+                    distances[neighbour] = steps
+                    queue.append(neighbour)
+
+        field = np.array(distances, dtype=np.int32).reshape(
+            self.height, self.width)
+        self.fields[name] = field
+        return field
+
+    def distance(self, name, row, col):
+        """
+        Steps from a tile to the nearest tile of a target area
+        Args:
+            name (str): Target name
+            row (int): Tile row
+            col (int): Tile column
+        Returns:
+            steps (int): Number of steps, None if it can't be reached
+        """
+        if not self.inside(row, col):
+            return None
+        steps = int(self.field(name)[row, col])
+        return steps if steps >= 0 else None
+
+    def find_path(self, start, end):
+        """
+        Shortest route between two tiles (A* search)
+        Args:
+            start (tuple): (row, col) to start from
+            end (tuple): (row, col) to get to
+        Returns:
+            path (list): (row, col) of each tile from start to end, [] if
+                         there is no route
+        """
+        if not (self.inside(*start) and self.inside(*end)
+                and self.walkable[start] and self.walkable[end]):
+            return []
+
+        def estimate(tile):
+            return abs(tile[0] - end[0]) + abs(tile[1] - end[1])
+
+        steps = {start: 0}
+        came_from = {start: None}
+        heap = [(estimate(start), 0, start)]
+        while heap:
+            ind, tile_steps, tile = heapq.heappop(heap)
+            if tile == end:
+                path = []
+                while tile is not None:
+                    path.append(tile)
+                    tile = came_from[tile]
+                return path[::-1]
+            if tile_steps > steps[tile]:
+                continue  # Already reached this tile in fewer steps
+            for neighbour in self.neighbours(*tile):
+                next_steps = tile_steps + 1
+                if next_steps < steps.get(neighbour, next_steps + 1):
+                    steps[neighbour] = next_steps
+                    came_from[neighbour] = tile
+                    heapq.heappush(heap, (next_steps + estimate(neighbour),
+                                          next_steps, neighbour))
+        return []
+
+    def update(self, top, left, bottom, right):
+        """
+        Re-reads an area of the map after tiles in it changed. Opening tiles
+        only shortens routes, so cached fields are patched by searching out
+        from the opened tiles. Fields that went through a closed tile are
+        dropped and rebuilt when next needed
+        Args:
+            top (int): Top row
+            left (int): Left column
+            bottom (int): Bottom row
+            right (int): Right column
+        """
+        top, left = max(top, 0), max(left, 0)
+        bottom = min(bottom, self.height - 1)
+        right = min(right, self.width - 1)
+        if top > bottom or left > right:
+            return
+
+        area = (slice(top, bottom + 1), slice(left, right + 1))
+        walkable = self.walkable_tiles(
+            np.array(self.map[top:bottom + 1, left:right + 1]))
+        opened = np.argwhere(walkable & ~self.walkable[area]) + (top, left)
+        closed = ~walkable & self.walkable[area]
+        self.walkable[area] = walkable
+
+        for name, field in list(self.fields.items()):
+            if (field[area][closed] >= 0).any():
+                del self.fields[name]
+            elif len(opened):
+                self.patch(name, field, [tuple(tile) for tile in opened])
+
+    def patch(self, name, field, opened):
+        """ Lowers distances in a field after the given tiles opened up """
+        top, left, bottom, right = self.targets[name]
+        heap = []
+        for row, col in opened:
+            if top <= row <= bottom and left <= col <= right:
+                steps = 0
+            else:
+                steps = min((field[tile] + 1 for tile in
+                             self.neighbours(row, col) if field[tile] >= 0),
+                            default=-1)
+            if steps >= 0:
+                field[row, col] = steps
+                heapq.heappush(heap, (steps, (row, col)))
+
+        while heap:
+            steps, tile = heapq.heappop(heap)
+            if steps > field[tile]:
+                continue
+            for neighbour in self.neighbours(*tile):
+                if field[neighbour] == -1 or field[neighbour] > steps + 1:
+                    field[neighbour] = steps + 1
+                    heapq.heappush(heap, (steps + 1, neighbour))
+
+
+@telemetry.timed("generate_map")
+def generate_map(seed, height=ROWS, width=COLS, fill_percent=0.35,
+                 iterations=7, workers=None, pool=None):
+    """
+    Generates a finished map (bear, smoothing and rocks) from a seed.
+    The same seed and settings always give the same map and bear spawn
+    Args:
+        seed (int): Map seed
+        height (int): Map height
+        width (int): Map width
+        fill_percent (float): Percentage of map area that starts as wall
+        iterations (int): Number of smoothing passes
+        workers (int): Processes to smooth the map in if it has
+                       PARALLEL_SMOOTH_TILES or more tiles, SMOOTH_WORKERS
+                       if None. Smaller maps are always smoothed in this
+                       process, which is quicker for them
+        pool (ProcessPoolExecutor): Process pool to smooth in, if the map
+                                    is smoothed in more than 1 process
+    Returns:
+        map (TileGrid): Map grid
+    """
+    if height * width < PARALLEL_SMOOTH_TILES:
+        workers = 1
+    elif workers is None:
+        workers = SMOOTH_WORKERS
+    rng = random.Random(seed)
+    place_bear(rng)
+    map = build_map(height, width, fill_percent, rng)
+
+    # set player, bear and goldilocks spawn points to empty space
+    for top, left, bottom, right in spawn_areas():
+        map[top:bottom + 1, left:right + 1] = 0
+
+    # Smooth the random map into something more cave shaped. Both ways
+    # give the same map
+    if workers > 1:
+        map = smooth_map_parallel(map, iterations, workers, pool)
+    else:
+        map = smooth_map(map, iterations)
+
+    # Add bear and rocks to map
+    map = spawn_bear(map, 10)
+    neighbours = NeighbourIndex(map)
+    map = spawn_rock(map, neighbours, rng)
+
+    # Dig tunnels if the bear or Goldilocks can't be reached
+    map = connect_map(map, height, width)
+
+    return map
+
+
+def map_cache_path(seed, height, width, fill_percent, iterations):
+    """
+    Path of the cached map for a set of generation settings. The file
+    name is a hash of the settings, so each set of settings gets its own
+    file
+    """
+    settings = (f"{MAP_FILE_VERSION}:{seed}:{height}:{width}:"
+                f"{fill_percent!r}:{iterations}")
+    key = hashlib.sha1(settings.encode()).hexdigest()
+    return os.path.join(MAP_CACHE_DIR, f"{key}.map")
+
+
+def save_map(path, map: TileGrid):
+    """
+    Saves a map and its bear spawn to a binary map file: a small header
+    followed by one byte per tile
+    Args:
+        path (str): File path
+        map (TileGrid): Map grid
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so a half written map is never read
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(MAP_FILE_HEADER.pack(MAP_FILE_MAGIC, MAP_FILE_VERSION,
+                                        map.height, map.width,
+                                        BEAR_Y, BEAR_X))
+        file.write(np.ascontiguousarray(map.tiles).tobytes())
+    os.replace(temp_path, path)
+
+
+def load_map(path, shared=False):
+    """
+    Memory maps a map file written by save_map and restores its bear
+    spawn. Changes made to the map are private to this process and are
+    never written back to the file
+    Args:
+        path (str): File path
+        shared (bool): Map the file read-only and keep changes in a
+                       MapOverlay, so the tiles are shared with every other
+                       game using the file. Otherwise changed pages are
+                       copied
+    Returns:
+        map (TileGrid or MapOverlay): Map grid, or None if the file isn't
+                                      a valid map
+    """
+    global BEAR_X, BEAR_Y
+    with open(path, "rb") as file:
+        header = file.read(MAP_FILE_HEADER.size)
+    if len(header) != MAP_FILE_HEADER.size:
+        return None
+    magic, version, height, width, bear_y, bear_x = (
+        MAP_FILE_HEADER.unpack(header))
+    if magic != MAP_FILE_MAGIC or version != MAP_FILE_VERSION:
+        return None
+
+    tiles = np.memmap(path, dtype=np.uint8, mode="r" if shared else "c",
+                      offset=MAP_FILE_HEADER.size, shape=(height, width))
+    BEAR_X, BEAR_Y = bear_x, bear_y
+    if shared:
+        return MapOverlay(tiles)
+    return TileGrid.from_tiles(tiles)
+
+
+def cached_map(seed, height=ROWS, width=COLS, fill_percent=0.35,
+               iterations=7, store=True):
+    """
+    Loads a map from the map cache, or generates and caches it if this
+    seed and settings haven't been generated before. See generate_map.
+    With store=False a map that isn't cached is generated but not added
+    to the cache
+    """
+    path = map_cache_path(seed, height, width, fill_percent, iterations)
+    if os.path.exists(path):
+        map = load_map(path)
+        if map is not None:
+            return map
+
+    map = generate_map(seed, height, width, fill_percent, iterations)
+    if store:
+        try:
+            save_map(path, map)
+        except OSError:
+            pass  # A read only cache only costs us the next load
+    return map
+
+
+def shared_map(seed, height=ROWS, width=COLS, fill_percent=0.35,
+               iterations=7):
+    """
+    Opens a seed's map read-only from the map cache, generating and
+    caching it first if needed (see cached_map). Every game playing the
+    seed shares the cached tiles, and keeps its own changes in a
+    MapOverlay
+    Returns:
+        map (MapOverlay): The map, or a TileGrid if it couldn't be cached
+    """
+    path = map_cache_path(seed, height, width, fill_percent, iterations)
+    map = load_map(path, shared=True) if os.path.exists(path) else None
+    if map is None:
+        map = cached_map(seed, height, width, fill_percent, iterations)
+        if os.path.exists(path):
+            map = load_map(path, shared=True) or map
+    return map
+
+
+def daily_seed():
+    """ Seed of today's map, the same for every game played today (UTC) """
+    return int(time.strftime("%Y%m%d", time.gmtime()))
+
+
+def save_game(path, session, infinite=False):
+    """
+    Saves a game to a binary save file: the world seed, the tiles the
+    player changed, their position, inventory and quest progress. The map
+    itself is made again from the seed, so a save is a few hundred bytes
+    Args:
+        path (str): File path
+        session (Session): Game to save, made by prepare_map so its seed
+                           is known
+        infinite (bool): The game is in an endless world
+    """
+    flags = SAVE_INFINITE if infinite else 0
+    for bit, name in enumerate(SAVE_FLAGS):
+        if getattr(session, name):
+            flags |= 1 << bit
+    parts = [SAVE_FILE_HEADER.pack(SAVE_FILE_MAGIC, SAVE_FILE_VERSION,
+                                   session.seed, flags, session.x, session.y,
+                                   len(session.inventory),
+                                   len(session.edits))]
+    for item, quantity in session.inventory.items():
+        name = item.encode("utf-8")
+        parts.append(SAVE_ITEM.pack(len(name), quantity) + name)
+    for (row, col), tile in session.edits.items():
+        parts.append(SAVE_EDIT.pack(row, col, tile))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Write to a temporary file first so a half written save is never read
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(b"".join(parts))
+    os.replace(temp_path, path)
+
+
+def load_game(path, session):
+    """
+    Restores a game saved by save_game into a session: its seed, tile
+    changes (to make again on the seed's map), position, inventory and
+    quest progress
+    Args:
+        path (str): File path
+        session (Session): Session to restore the game into
+    Returns:
+        infinite (bool): True if the game is in an endless world, None if
+                         the file isn't a valid save
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return None
+    if len(data) < SAVE_FILE_HEADER.size:
+        return None
+    magic, version, seed, flags, x, y, items, edits = (
+        SAVE_FILE_HEADER.unpack_from(data))
+    if magic != SAVE_FILE_MAGIC or version != SAVE_FILE_VERSION:
+        return None
+
+    offset = SAVE_FILE_HEADER.size
+    inventory = {}
+    try:
+        for ind in range(items):
+            length, quantity = SAVE_ITEM.unpack_from(data, offset)
+            offset += SAVE_ITEM.size
+            name = data[offset:offset + length].decode("utf-8")
+            inventory[name] = quantity
+            offset += length
+        if len(data) != offset + edits * SAVE_EDIT.size:
+            return None
+        changes = {(row, col): tile for row, col, tile in
+                   SAVE_EDIT.iter_unpack(data[offset:])}
+    except (struct.error, UnicodeDecodeError):
+        return None
+
+    session.seed = seed
+    session.x = x
+    session.y = y
+    session.inventory = inventory
+    session.edits = changes
+    for bit, name in enumerate(SAVE_FLAGS):
+        setattr(session, name, bool(flags & 1 << bit))
+    return bool(flags & SAVE_INFINITE)
+
+
+def take_pooled_map():
+    """
+    Takes a ready made map from the map pool, if there is one. Each map is
+    claimed by renaming it first, so two games never get the same map.
+    The file is deleted once loaded: a saved game on the map makes it
+    again from its seed, so pooled maps don't pile up in the map cache
+    Returns:
+        seed (int): Map seed, or None if the pool is empty
+        map (TileGrid): Map grid, or None if the pool is empty
+    """
+    try:
+        names = os.listdir(MAP_POOL_DIR)
+    except OSError:
+        return None, None
+
+    for name in names:
+        seed = name[:-len(".map")]
+        if not name.endswith(".map") or not seed.isdigit():
+            continue
+        path = os.path.join(MAP_POOL_DIR, name)
+        claimed = f"{path}.{os.getpid()}.taken"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue  # Another game took it first
+        try:
+            map = load_map(claimed)
+        finally:
+            # The memory map keeps the tiles after the file is deleted
+            os.remove(claimed)
+        if map is not None:
+            return int(seed), map
+    return None, None
+
+
+def fill_map_pool(size, workers=1, pool=None):
+    """
+    Generates maps until the map pool holds "size" ready-to-play maps
+    Args:
+        size (int): Number of maps to keep in the pool
+        workers (int): Processes to smooth each map in, if it's big
+                       enough (see generate_map)
+        pool (ProcessPoolExecutor): Process pool to smooth in
+    Returns:
+        count (int): Number of maps generated
+    """
+    os.makedirs(MAP_POOL_DIR, exist_ok=True)
+    ready = [name for name in os.listdir(MAP_POOL_DIR)
+             if name.endswith(".map")]
+    count = 0
+    for ind in range(size - len(ready)):
+        seed = random.randrange(2 ** 32)
+        map = generate_map(seed, workers=workers, pool=pool)
+        save_map(os.path.join(MAP_POOL_DIR, f"{seed}.map"), map)
+        count += 1
+    return count
+
+
+def run_map_pool(size, interval=1.0, workers=SMOOTH_WORKERS):
+    """
+    Keeps the map pool topped up to "size" maps, forever. Maps of
+    PARALLEL_SMOOTH_TILES or more are smoothed across "workers" processes,
+    started once and kept for every map, so refilling the pool after a
+    rush of players takes less time
+    Args:
+        size (int): Number of maps to keep in the pool
+        interval (float): Seconds between checks of the pool
+        workers (int): Processes to smooth each map in
+    """
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if workers > 1 and ROWS * COLS >= PARALLEL_SMOOTH_TILES:
+            pool = stack.enter_context(ProcessPoolExecutor(workers))
+        while True:
+            fill_map_pool(size, workers, pool)
+            time.sleep(interval)
+
+
+def spawn_areas():
+    """
+    Areas of the map that are cleared to open space before smoothing, so
+    the player, bear and goldilocks aren't spawned inside a wall
+    Returns:
+        areas (list): (top, left, bottom, right) areas, inclusive
+    """
+    return [
+        (22, 38, 26, 42),  # player
+        (BEAR_Y - 1, BEAR_X - 1, BEAR_Y + 2, BEAR_X + 2),
+        (GOLDILOCKS_Y - 1, GOLDILOCKS_X - 1,
+         GOLDILOCKS_Y + 2, GOLDILOCKS_X + 2),
+    ]
+
+
+class ChunkManager():
+    """
+    Endless map, generated in CHUNK_SIZE x CHUNK_SIZE chunks as they are
+    needed. Each chunk is generated from (seed, chunk_row, chunk_col)
+    with the same fill + smooth_map + spawn_rock steps as the fixed map,
+    so the world is the same every time a chunk is (re)generated.
+    Only the most recently used chunks are kept in memory, changes made
+    to the map are kept separately so they survive a chunk being dropped.
+    Supports map[row, col] and map[top:bottom, left:right] like TileGrid.
+    Row 0 and column 0 are wall, the map is endless down and to the right.
+    Safe to read from several threads, so the game server's players can
+    share one world, each with a MapOverlay on top.
+    """
+
+    def __init__(self, seed, fill_percent, iterations=7, clearings=(),
+                 cache_size=CHUNK_CACHE):
+        self.seed = seed
+        self.fill_percent = fill_percent
+        self.iterations = iterations
+        self.clearings = list(clearings)  # Cleared before smoothing
+        self.cache_size = cache_size
+        self.height = WORLD_LIMIT
+        self.width = WORLD_LIMIT
+        self.chunks = OrderedDict()  # (chunk_row, chunk_col): tiles
+        self.edits = {}  # (chunk_row, chunk_col): {(row, col): tile}
+        self.lock = threading.Lock()  # Guards chunks between threads
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def noise(self, chunk_row, chunk_col):
+        """
+        Random weighted fill of 1's (wall) and 0's (open space) for a
+        chunk, before smoothing
+        """
+        if chunk_row < 0 or chunk_col < 0:
+            # Outside the world counts as wall
+            return np.ones((CHUNK_SIZE, CHUNK_SIZE), dtype=np.uint8)
+        rng = np.random.default_rng((self.seed, chunk_row, chunk_col))
+        fill = rng.random((CHUNK_SIZE, CHUNK_SIZE)) < self.fill_percent
+        return fill.astype(np.uint8)
+
+    def generate(self, chunk_row, chunk_col):
+        """
+        Generates the tiles of a chunk
+        Args:
+            chunk_row (int): Chunk row index
+            chunk_col (int): Chunk column index
+        Returns:
+            tiles (ndarray): CHUNK_SIZE x CHUNK_SIZE array of tiles
+        """
+        size = CHUNK_SIZE + 2 * CHUNK_MARGIN
+        top = chunk_row * CHUNK_SIZE - CHUNK_MARGIN
+        left = chunk_col * CHUNK_SIZE - CHUNK_MARGIN
+        region = TileGrid(size, size)
+
+        # Fill the chunk and the margin around it from the raw noise of it
+        # and its neighbours
+        for near_row in range(chunk_row - 1, chunk_row + 2):
+            for near_col in range(chunk_col - 1, chunk_col + 2):
+                noise = self.noise(near_row, near_col)
+                row = near_row * CHUNK_SIZE - top
+                col = near_col * CHUNK_SIZE - left
+                region[max(row, 0):row + CHUNK_SIZE,
+                       max(col, 0):col + CHUNK_SIZE] = noise[
+                    max(-row, 0):size - row, max(-col, 0):size - col]
+
+        # Set world border to 1's
+        if top <= 0:
+            region[:1 - top] = 1
+        if left <= 0:
+            region[:, :1 - left] = 1
+
+        for clear_top, clear_left, clear_bottom, clear_right in (
+                self.clearings):
+            region[max(clear_top - top, 0):max(clear_bottom - top + 1, 0),
+                   max(clear_left - left, 0):
+                   max(clear_right - left + 1, 0)] = 0
+
+        smooth_map(region, self.iterations)
+        spawn_rock(region, rng=random.Random(
+            f"{self.seed}:{chunk_row}:{chunk_col}"))
+
+        tiles = region[CHUNK_MARGIN:CHUNK_MARGIN + CHUNK_SIZE,
+                       CHUNK_MARGIN:CHUNK_MARGIN + CHUNK_SIZE].copy()
+        for (row, col), tile in self.edits.get((chunk_row, chunk_col),
+                                               {}).items():
+            tiles[row, col] = tile
+        return tiles
+
+    def chunk(self, chunk_row, chunk_col):
+        """
+        Returns the tiles of a chunk, generating it if it isn't in memory
+        and dropping the least recently used chunk if there are too many
+        """
+        key = (chunk_row, chunk_col)
+        with self.lock:
+            tiles = self.chunks.get(key)
+            if tiles is not None:
+                self.chunks.move_to_end(key)
+                return tiles
+        tiles = self.generate(chunk_row, chunk_col)
+        with self.lock:
+            self.chunks[key] = tiles
+            if len(self.chunks) > self.cache_size:
+                self.chunks.popitem(last=False)
+        return tiles
+
+    def region(self, top, left, bottom, right):
+        """
+        Returns a copy of the tiles from top, left to bottom, right
+        (inclusive). Anything outside the world is wall
+        """
+        tiles = np.ones((bottom - top + 1, right - left + 1), dtype=np.uint8)
+        for chunk_row in range(max(top, 0) // CHUNK_SIZE,
+                               max(bottom, 0) // CHUNK_SIZE + 1):
+            for chunk_col in range(max(left, 0) // CHUNK_SIZE,
+                                   max(right, 0) // CHUNK_SIZE + 1):
+                chunk_top = chunk_row * CHUNK_SIZE
+                chunk_left = chunk_col * CHUNK_SIZE
+                row_from = max(top, chunk_top)
+                row_to = min(bottom, chunk_top + CHUNK_SIZE - 1)
+                col_from = max(left, chunk_left)
+                col_to = min(right, chunk_left + CHUNK_SIZE - 1)
+                if row_from > row_to or col_from > col_to:
+                    continue
+                chunk = self.chunk(chunk_row, chunk_col)
+                tiles[row_from - top:row_to - top + 1,
+                      col_from - left:col_to - left + 1] = chunk[
+                    row_from - chunk_top:row_to - chunk_top + 1,
+                    col_from - chunk_left:col_to - chunk_left + 1]
+        return tiles
+
+    @overload
+    def __getitem__(self, index: tuple[int, int]) -> int: ...
+
+    @overload
+    def __getitem__(self, index: tuple[int | slice, slice]
+                    | tuple[slice, int]) -> np.ndarray: ...
+
+    def __getitem__(self, index):
+        row, col = index
+        if isinstance(row, slice) or isinstance(col, slice):
+            rows = self._span(row)
+            cols = self._span(col)
+            tiles = self.region(rows[0], cols[0], rows[1], cols[1])
+            if not isinstance(row, slice):
+                return tiles[0]
+            if not isinstance(col, slice):
+                return tiles[:, 0]
+            return tiles
+        if row < 0 or col < 0:
+            return 1
+        chunk = self.chunk(row // CHUNK_SIZE, col // CHUNK_SIZE)
+        return int(chunk[row % CHUNK_SIZE, col % CHUNK_SIZE])
+
+    def __setitem__(self, index, tile):
+        rows, cols = (self._span(part) for part in index)
+        for row in range(rows[0], rows[1] + 1):
+            for col in range(cols[0], cols[1] + 1):
+                key = (row // CHUNK_SIZE, col // CHUNK_SIZE)
+                offset = (row % CHUNK_SIZE, col % CHUNK_SIZE)
+                self.edits.setdefault(key, {})[offset] = tile
+                if key in self.chunks:
+                    self.chunks[key][offset] = tile
+
+    @staticmethod
+    def _span(index):
+        """ Converts an int or slice index to an inclusive (start, end) """
+        if isinstance(index, slice):
+            return (index.start or 0), index.stop - 1
+        return index, index
+
+
+class MapOverlay():
+    """
+    Read-only map shared by every game playing it, with this game's
+    changes (rocks picked up, the opened Goldilocks area) kept separately
+    in a small dict. The shared tiles are never written, so they stay in
+    memory once however many games use them.
+    Supports map[row, col] and map[top:bottom, left:right] like TileGrid.
+    """
+
+    def __init__(self, base):
+        """
+        Args:
+            base (ndarray or ChunkManager): Read-only 2D uint8 array of map
+                                            tiles, e.g. a memory map opened
+                                            with load_map(shared=True), or
+                                            an endless world
+        """
+        self.base = base
+        self.edits = {}  # (row, col): tile
+
+    @property
+    def height(self):
+        return self.base.shape[0]
+
+    @property
+    def width(self):
+        return self.base.shape[1]
+
+    def __len__(self):
+        return self.height
+
+    @overload
+    def __getitem__(self, index: tuple[int, int]) -> int: ...
+
+    @overload
+    def __getitem__(self, index: tuple[int | slice, slice]
+                    | tuple[slice, int]) -> np.ndarray: ...
+
+    def __getitem__(self, index):
+        tiles = self.base[index]
+        if not isinstance(tiles, np.ndarray):
+            return self.edits.get(index, int(tiles))  # Single tile
+        if not self.edits:
+            return tiles
+        tiles = tiles.copy()
+        rows, cols = (self._span(part, size)
+                      for part, size in zip(index, self.base.shape))
+        for (row, col), tile in self.edits.items():
+            if rows[0] <= row <= rows[1] and cols[0] <= col <= cols[1]:
+                offset = tuple(
+                    at - span[0] for at, span, part in
+                    zip((row, col), (rows, cols), index)
+                    if isinstance(part, slice))
+                tiles[offset] = tile
+        return tiles
+
+    def __setitem__(self, index, tile):
+        rows, cols = (self._span(part, size)
+                      for part, size in zip(index, self.base.shape))
+        for row in range(rows[0], rows[1] + 1):
+            for col in range(cols[0], cols[1] + 1):
+                if self.base[row, col] == tile:
+                    self.edits.pop((row, col), None)
+                else:
+                    self.edits[(row, col)] = tile
+
+    def _span(self, index, size):
+        """ Converts an int or slice index to an inclusive (start, end) """
+        if isinstance(self.base, ChunkManager):
+            # Negative indexes are outside an endless world, not from its end
+            return ChunkManager._span(index)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(size)
+            return start, stop - 1
+        return index % size, index % size
+
+
+def prepare_map(infinite=False, seed=None, shared=False, store=True):
+    """
+    Gets the map for a new game ready
+    Args:
+        infinite (bool): Endless chunk generated world instead of a
+                         ROWS x COLS map
+        seed (int): World seed. Maps made from a given seed are cached, a
+                    random seed is used if None
+        shared (bool): Play the seed's cached map read-only, with this
+                       game's changes in a MapOverlay
+        store (bool): Add a seed's map to the map cache if it isn't
+                      there. Resumed games don't, as their seed may be a
+                      random one that's never played again
+    Returns:
+        map (TileGrid, MapOverlay or ChunkManager): The map, with the bear
+                                                    spawned
+    """
+    if infinite:
+        # Chunks (and their rocks) are generated as the player explores
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        place_bear(random.Random(seed))
+        map = ChunkManager(seed, 0.35, clearings=spawn_areas())
+        map = spawn_bear(map, 10)
+        map = connect_map(map)
+    elif seed is None:
+        # Use a map made ahead of time by the map pool if there is one
+        seed, map = take_pooled_map()
+        if map is None:
+            seed = random.randrange(2 ** 32)
+            map = generate_map(seed)
+    elif shared:
+        map = shared_map(seed)
+    else:
+        map = cached_map(seed, store=store)
+    # Saved games are kept as the seed plus what the player changed
+    current_session().seed = seed
+    return map
+
+
+class EndOfInput(Exception):
+    """ Raised by HeadlessCurses when the game asks for a key after the
+    last key of its script """
+
+
+class HeadlessWindow():
+    """
+    In-memory window (or pad) for HeadlessCurses, with the window methods
+    the game uses. Text is kept one character per cell, with its attributes
+    (colour pair, reverse) alongside, so the screen can be checked after a
+    replay or sent to a terminal. Like curses, a wide character (an emoji)
+    takes two cells, the second one holds WIDE_FILLER.
+    Each line is kept as a str, and its attributes as an array of 32 bit
+    ints, so a game server holding many players' windows stays small.
+    As in curses, refresh() sends the screen to the terminal, and getch()
+    refreshes the window first if it changed since it was last shown
+    """
+
+    WIDE_FILLER = "\0"  # Second cell of a wide character
+
+    def __init__(self, backend, height, width, y=0, x=0):
+        self.backend = backend
+        self.height = height
+        self.width = width
+        self.y = y  # Screen position of the top left corner
+        self.x = x
+        self.cells = [" " * width] * height
+        self.attrs = [array("I", bytes(4 * width)) for ind in range(height)]
+        self.attr = 0  # Attributes turned on with attron
+        self.cursor = (0, 0)
+        self.delay = -1  # getch timeout in ms, -1 waits for a key
+        self.changed = False  # Drawn on since it was last noutrefreshed
+
+    def addstr(self, *args):
+        if isinstance(args[0], str):
+            (row, col), text = self.cursor, args[0]
+            attr = args[1] if len(args) > 1 else 0
+        else:
+            row, col, text = args[:3]
+            attr = args[3] if len(args) > 3 else 0
+        if not (0 <= row < self.height and 0 <= col < self.width):
+            raise c.error("addstr() returned ERR")
+        filler = self.WIDE_FILLER
+        if not text.isascii():
+            text = "".join(
+                char + filler if unicodedata.east_asian_width(char) in "WF"
+                else char for char in text)
+        text = text[:self.width - col]
+        end = col + len(text)
+        line = self.cells[row]
+        # Writing over half of a wide character blanks the other half
+        before = line[:col]
+        if line[col] == filler and col > 0:
+            before = line[:col - 1] + " "
+        after = line[end:]
+        if after[:1] == filler:
+            after = " " + after[1:]
+        self.cells[row] = before + text + after
+        self.attrs[row][col:end] = array("I", [attr | self.attr]) * len(text)
+        self.cursor = (row, end)
+        self.changed = True
+
+    def addch(self, row, col, ch, attr=0):
+        self.addstr(row, col, ch[:1], attr)
+
+    def border(self, *args):
+        self.cells = ["|" + line[1:-1] + "|" for line in self.cells]
+        self.cells[0] = self.cells[-1] = "|" + "-" * (self.width - 2) + "|"
+        for line in (self.attrs[0], self.attrs[-1]):
+            line[:] = array("I", [self.attr]) * self.width
+        for line in self.attrs:
+            line[0] = line[-1] = self.attr
+        self.changed = True
+
+    def erase(self):
+        self.cells = [" " * self.width] * self.height
+        for line in self.attrs:
+            line[:] = array("I", bytes(4 * self.width))
+        self.cursor = (0, 0)
+        self.changed = True
+
+    clear = erase
+
+    def derwin(self, height, width, y, x):
+        return HeadlessWindow(self.backend, height, width,
+                              self.y + y, self.x + x)
+
+    def getch(self):
+        if self.changed:
+            self.refresh()
+        return self.backend.read_key(self.delay)
+
+    def nodelay(self, flag):
+        self.delay = 0 if flag else -1
+
+    def timeout(self, delay):
+        self.delay = delay
+
+    def keypad(self, flag):
+        pass
+
+    def attron(self, attr):
+        self.attr |= attr
+
+    def attroff(self, attr):
+        self.attr &= ~attr
+
+    def touchwin(self):
+        self.changed = True
+
+    def overwrite(self, dest, from_row, from_col, to_top, to_left,
+                  to_bottom, to_right):
+        copy_lines(self.cells, self.attrs, from_row, from_col,
+                   dest.cells, dest.attrs, to_top, to_left,
+                   to_bottom, to_right)
+        dest.changed = True
+
+    def noutrefresh(self, *pad_args):
+        """ Copies the window (or part of a pad) onto the backend screen """
+        if pad_args:
+            from_row, from_col, top, left, bottom, right = pad_args
+        else:
+            from_row, from_col = 0, 0
+            top, left = self.y, self.x
+            bottom = self.y + self.height - 1
+            right = self.x + self.width - 1
+        screen = self.backend.screen
+        bottom = min(bottom, len(screen) - 1,
+                     top + self.height - from_row - 1)
+        right = min(right, len(screen[0]) - 1,
+                    left + self.width - from_col - 1)
+        copy_lines(self.cells, self.attrs, from_row, from_col,
+                   screen, self.backend.attrs, top, left, bottom, right)
+        self.changed = False
+
+    def refresh(self, *pad_args):
+        self.noutrefresh(*pad_args)
+        self.backend.doupdate()
+
+
+def copy_lines(cells, attrs, from_row, from_col, dest_cells, dest_attrs,
+               top, left, bottom, right):
+    """
+    Copies a block of HeadlessWindow lines (text and attributes) onto
+    another window's or the screen's lines
+    Args:
+        cells (list): Source lines of text
+        attrs (list): Source lines of attributes
+        from_row (int): First source line
+        from_col (int): First source column
+        dest_cells (list): Destination lines of text, changed in place
+        dest_attrs (list): Destination lines of attributes, changed in place
+        top (int): First destination line
+        left (int): First destination column
+        bottom (int): Last destination line (inclusive)
+        right (int): Last destination column (inclusive)
+    """
+    width = right - left + 1
+    for row in range(top, bottom + 1):
+        source = from_row + row - top
+        text = cells[source][from_col:from_col + width]
+        line = dest_cells[row]
+        dest_cells[row] = line[:left] + text + line[left + len(text):]
+        dest_attrs[row][left:left + len(text)] = attrs[source][
+            from_col:from_col + len(text)]
+
+
+class HeadlessCurses():
+    """
+    Stand-in for the curses module that plays the game without a terminal.
+    Keys come from a script instead of the keyboard, windows live in
+    memory, and the clock only moves when the game waits for a key, so a
+    game runs as fast as its logic allows. Install with use_backend(), it
+    also replaces the clock used by the fight.
+    """
+
+    error = TERMINAL.error
+    A_REVERSE = TERMINAL.A_REVERSE
+    COLOR_BLACK = TERMINAL.COLOR_BLACK
+    COLOR_BLUE = TERMINAL.COLOR_BLUE
+    COLOR_WHITE = TERMINAL.COLOR_WHITE
+    KEY_DOWN = TERMINAL.KEY_DOWN
+    KEY_LEFT = TERMINAL.KEY_LEFT
+    KEY_RIGHT = TERMINAL.KEY_RIGHT
+    KEY_UP = TERMINAL.KEY_UP
+
+    def __init__(self, script, delay=0.1, lines=24, cols=80):
+        """
+        Args:
+            script (list): Keys to play, a key is a character, a key code,
+                           "ESC", "ENTER" or a curses KEY_ name. A
+                           [seconds, key] pair presses the key that many
+                           seconds after the previous key, other keys
+                           "delay" seconds after it
+            delay (float): Default seconds between keys
+            lines (int): Screen height
+            cols (int): Screen width
+        """
+        self.events = []  # (time, key code)
+        at = 0.0
+        for item in script:
+            if isinstance(item, (list, tuple)):
+                wait, key = item
+            else:
+                wait, key = delay, item
+            at += wait
+            self.events.append((at, self.key_code(key)))
+        self.next_event = 0
+        self.now = 0.0
+        self.ended = False
+        self.screen = [" " * cols] * lines
+        self.attrs = [array("I", bytes(4 * cols)) for ind in range(lines)]
+        self.stdscr = HeadlessWindow(self, lines, cols)
+
+    @staticmethod
+    def key_code(key):
+        """ Converts a script key to the key code getch() returns """
+        if isinstance(key, int):
+            return key
+        if len(key) == 1:
+            return ord(key)
+        if key in ("ESC", "ENTER"):
+            return globals()[key]
+        return getattr(TERMINAL, key)
+
+    def read_key(self, delay):
+        """
+        Next scripted key, moving the clock on to when it's pressed
+        Args:
+            delay (int): Most ms to wait for the key, -1 waits for ever
+        Returns:
+            key (int): Key code, -1 if no key was pressed in time
+        """
+        if self.next_event == len(self.events):
+            raise EndOfInput()
+        at, key = self.events[self.next_event]
+        if delay >= 0 and at > self.now + delay / 1000:
+            self.now += delay / 1000
+            return -1
+        self.now = max(self.now, at)
+        self.next_event += 1
+        return key
+
+    def screen_text(self):
+        """ The screen as shown after the last frame, one string per line.
+        Wide characters take two cells, so each line is cols wide """
+        return [line.replace(HeadlessWindow.WIDE_FILLER, "")
+                for line in self.screen]
+
+    # Clock
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    # curses module functions
+    def wrapper(self, func, *args, **kwargs):
+        return func(self.stdscr, *args, **kwargs)
+
+    def initscr(self):
+        return self.stdscr
+
+    def newwin(self, height, width, y=0, x=0):
+        return HeadlessWindow(self, height, width, y, x)
+
+    def newpad(self, height, width):
+        return HeadlessWindow(self, height, width)
+
+    def color_pair(self, number):
+        return number << 8
+
+    def endwin(self):
+        self.ended = True
+
+    def isendwin(self):
+        return self.ended
+
+    def init_pair(self, number, foreground, background):
+        pass
+
+    def noecho(self):
+        pass
+
+    def cbreak(self):
+        pass
+
+    def curs_set(self, visibility):
+        pass
+
+    def flash(self):
+        pass
+
+    def doupdate(self):
+        pass
+
+
+class SocketTerminal(HeadlessCurses):
+    """
+    Backend for one player of the game server (see serve). Keys come from
+    the player's socket connection and each frame is sent back as ANSI
+    escape codes, only for the screen lines that changed since the last
+    frame. The game runs in its own thread on the real clock, while the
+    server's event loop does the socket reads and writes
+    """
+
+    # ANSI cursor key sequences
+    ARROWS = {"A": TERMINAL.KEY_UP, "B": TERMINAL.KEY_DOWN,
+              "C": TERMINAL.KEY_RIGHT, "D": TERMINAL.KEY_LEFT}
+
+    def __init__(self, loop, writer, lines=24, cols=80):
+        """
+        Args:
+            loop (asyncio.AbstractEventLoop): Loop that owns the socket
+            writer (asyncio.StreamWriter): Player's connection
+            lines (int): Screen height
+            cols (int): Screen width
+        """
+        super().__init__([], lines=lines, cols=cols)
+        self.loop = loop
+        self.writer = writer
+        self.keys = queue.Queue()
+        self.pairs = {}  # Colour pair number: (foreground, background)
+        # Lines as last sent to the player
+        self.sent: list[str | None] = [None] * lines
+
+    def feed(self, data):
+        """
+        Turns bytes received from the player into key presses
+        Args:
+            data (bytes): Terminal input
+        """
+        text = data.decode("utf-8", "ignore")
+        ind = 0
+        while ind < len(text):
+            char = text[ind]
+            ind += 1
+            if (char == "\x1b" and text[ind:ind + 1] in ("[", "O")
+                    and text[ind + 1:ind + 2] in self.ARROWS):
+                key = self.ARROWS[text[ind + 1]]
+                ind += 2
+            elif char in "\r\n":
+                key = ENTER
+                if text[ind - 1:ind + 1] == "\r\n":
+                    ind += 1
+            else:
+                key = ord(char)
+            self.keys.put(key)
+
+    def close(self):
+        """ Ends the game, the player has gone """
+        self.keys.put(None)
+
+    def read_key(self, delay):
+        try:
+            key = self.keys.get(timeout=None if delay < 0 else delay / 1000)
+        except queue.Empty:
+            return -1
+        if key is None:
+            self.keys.put(None)  # Any later read ends the game too
+            raise EndOfInput()
+        return key
+
+    def send(self, text):
+        """ Writes to the player's connection from the game's thread """
+        self.loop.call_soon_threadsafe(self.writer.write,
+                                       text.encode("utf-8"))
+
+    def style(self, attr):
+        """ SGR escape code for a cell's attributes """
+        codes = ["0"]
+        if attr >> 8 & 0xFF in self.pairs:
+            foreground, background = self.pairs[attr >> 8 & 0xFF]
+            codes += [str(30 + foreground), str(40 + background)]
+        if attr & self.A_REVERSE:
+            codes.append("7")
+        return f"\x1b[{';'.join(codes)}m"
+
+    def line_text(self, row):
+        """ ANSI text that draws a screen line, one run per attribute """
+        cells, attrs = self.screen[row], self.attrs[row]
+        filler = HeadlessWindow.WIDE_FILLER
+        parts = []
+        attr = None
+        for col, cell in enumerate(cells):
+            if cell == filler:
+                if col and cells[col - 1] != filler:
+                    continue  # Second half of a wide character
+                cell = " "
+            elif (col == len(cells) - 1
+                  and unicodedata.east_asian_width(cell) in "WF"):
+                cell = " "  # No room for a wide character
+            if attrs[col] != attr:
+                attr = attrs[col]
+                parts.append(self.style(attr))
+            parts.append(cell)
+        return "".join(parts)
+
+    # Clock
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    # curses module functions
+    def wrapper(self, func, *args, **kwargs):
+        # Hide the cursor and clear the screen, and undo that at the end
+        self.send("\x1b[?25l\x1b[0m\x1b[2J")
+        try:
+            return func(self.stdscr, *args, **kwargs)
+        finally:
+            self.send("\x1b[0m\x1b[2J\x1b[H\x1b[?25h")
+
+    def init_pair(self, number, foreground, background):
+        self.pairs[number] = (foreground, background)
+
+    def doupdate(self):
+        output = []
+        for row in range(len(self.screen)):
+            text = self.line_text(row)
+            if text != self.sent[row]:
+                self.sent[row] = text
+                output.append(f"\x1b[{row + 1};1H{text}")
+        if output:
+            self.send("".join(output) + "\x1b[0m")
+
+
+def use_backend(backend=None):
+    """
+    Makes the current thread play a new session on a different
+    screen/keyboard backend and clock, or go back to the terminal game if
+    backend is None
+    Args:
+        backend (HeadlessCurses): Backend to use
+    """
+    use_session(None if backend is None else Session(backend, backend))
+
+
+def replay(script, seed=0, infinite=False, fog=False, delay=0.1,
+           save=None):
+    """
+    Plays a game without a terminal, pressing the keys in a script as fast
+    as the game can take them. The game ends when it asks for a key after
+    the end of the script
+    Args:
+        script (list): Keys to press, see HeadlessCurses
+        seed (int): World seed, also seeds the fight's random numbers
+        infinite (bool): Endless chunk generated world
+        fog (bool): Fog of war
+        delay (float): Default seconds between keys
+        save (str): Save file to keep the game in and resume it from, see
+                    main
+    Returns:
+        backend (HeadlessCurses): Backend the game ran on, with the final
+                                  screen and clock
+    """
+    backend = HeadlessCurses(script, delay)
+    use_backend(backend)
+    random.seed(seed)
+    try:
+        # Keep the game's own messages (e.g. "GAME OVER") off the console
+        with contextlib.redirect_stdout(io.StringIO()):
+            backend.wrapper(main, infinite=infinite, seed=seed, fog=fog,
+                            save=save)
+    except EndOfInput:
+        pass
+    finally:
+        use_backend(None)
+    return backend
+
+
+def run_replays(path, sessions=1, seed=None, infinite=False, fog=False):
+    """
+    Replays a key script (a JSON list, see HeadlessCurses) over and over
+    and prints how many games a minute were played
+    Args:
+        path (str): Script file
+        sessions (int): Number of games to play
+        seed (int): World seed for every game, game n uses seed n if None
+        infinite (bool): Endless chunk generated world
+        fog (bool): Fog of war
+    """
+    with open(path) as file:
+        script = json.load(file)
+
+    start = time.perf_counter()
+    for session in range(sessions):
+        replay(script, session if seed is None else seed, infinite, fog)
+    elapsed = time.perf_counter() - start
+    print(f"{sessions} sessions of {len(script)} keys in {elapsed:.2f}s "
+          f"({sessions / elapsed * 60:.0f} sessions per minute)")
+
+
+def main(stdscr, infinite=False, seed=None, map=None, fog=False,
+         shared=False, save=None):
     """
     Initializes curses window and settings, and runs all functions.
+    Args:
+        stdscr (window): Main curses window
+        infinite (bool): Explore an endless chunk generated world instead
+                         of a ROWS x COLS map
+        seed (int): World seed. Maps made from a given seed are cached, a
+                    random seed is used if None
+        map (TileGrid, MapOverlay or ChunkManager): Map made by
+                                                    prepare_map ahead of
+                                                    time, made now if None
+        fog (bool): Fog of war, only draw the tiles the player can see
+        shared (bool): Play the seed's map read-only, see shared_map
+        save (str): Save file. The game is resumed from it if there is one,
+                    and saved to it after every move
     """
     stdscr = c.initscr()  # Initialize curses module, returns window
     c.noecho()  # Prevents keystrokes being echoed on screen
@@ -750,7 +3727,8 @@ def main(stdscr):
             except:
                 pass
     stdscr.keypad(True)  # Allows screen to read keystrokes
-    stdscr.nodelay(True)  # getch will return -1, not ERR, if no key is pressed
+    # getch waits for a key press, so an idle game uses no CPU
+    stdscr.nodelay(False)
     # color pairs
     c.init_pair(1, c.COLOR_WHITE, c.COLOR_BLACK)
     c.init_pair(2, c.COLOR_BLACK, c.COLOR_WHITE)
@@ -764,63 +3742,55 @@ def main(stdscr):
         "w_black_goldilocks_adj": c.color_pair(1)
     }
 
-    map = build_map(ROWS, COLS, 0.35)
-
-    # set player spawn point to empty space
-    for row in range(22, 27):
-        for col in range(38, 43):
-            map[row][col] = 0
-
-    # set bear spawn point to empty space
-    for row in range(BEAR_Y - 1, BEAR_Y + 3):
-        for col in range(BEAR_X - 1, BEAR_X + 3):
-            map[row][col] = 0
-
-    # set goldilocks spawn point to empty space
-    for row in range(GOLDILOCKS_Y - 1, GOLDILOCKS_Y + 3):
-        for col in range(GOLDILOCKS_X - 1, GOLDILOCKS_X + 3):
-            map[row][col] = 0
-
-    pad = c.newpad(ROWS + 1, COLS + 1)
-
-    # Smooth the random map into something more cave shaped
-    for ind in range(7):
-        map = smooth_map(map)
-
-    # Add bear and rocks to map
-    map = spawn_bear(map, 10)
-    map = spawn_rock(map)
-
-    # Initial screen position
-    x, y = 0, 12
+    # Position, inventory and quest progress of the player
+    player = current_session()
+    prepared_seed = player.seed
+    resumed = load_game(save, player) if save is not None else None
+    if resumed is not None:
+        # Make the saved game's map, unless it's the one already prepared
+        if (map is None or player.seed != prepared_seed
+                or resumed != infinite):
+            infinite = resumed
+            map = prepare_map(infinite, player.seed, shared, store=False)
+        for (row, col), tile in player.edits.items():
+            map[row, col] = tile
+    elif map is None:
+        map = prepare_map(infinite, seed, shared)
     # Tile that player moves to
     next_tile = 0
 
-    # Draw the map to the pad
-    draw_map(pad, map, colors)
-
-    # Set the inventory dictionary
-    global inventory
-    inventory = inventory()
-
-    # quest and quest complete status
-    quest = False
-    quest_complete = False
+    # Only the visible part of the map is drawn, as the player moves
+    view = Viewport(VIEW_ROWS, VIEW_COLS, VIEW_MARGIN)
+    renderer = MapRenderer(view, map, colors)
+    fov = FieldOfView(map) if fog else None
+    if fov is not None:
+        renderer.reveal(fov.visible_from(player.y + 12, player.x + 40))
+    renderer.show_sprite(BEAR_Y, BEAR_X, "🐻")
+    if player.show_goldilocks:
+        renderer.show_sprite(GOLDILOCKS_Y, GOLDILOCKS_X, "👧")
+    if player.show_porridge:
+        renderer.show_sprite(PORRIDGE_Y, PORRIDGE_X, "🥣")
+    # Walking distances to the bear, Goldilocks and the porridge
+    paths = PathFinder(map)
+
+    # Set the inventory window
+    inventory()
 
     # Controls
     controls()
 
     # Generate quest window
-    update_quest(quest, quest_complete)
+    update_quest(player.quest, player.quest_complete)
 
-    show_goldilocks = False
-    show_porridge = False
-
-    goldilocks_spawned = False  # True if Goldilocks has spawned
+    # Paint the map around the start now, so the first frame's full paint
+    # doesn't wipe the player, and show the HUD windows
+    renderer.scroll(player.y, player.x)
+    frame.show()
 
     while True:
         # main movement
         key = stdscr.getch()
+        started = telemetry.now()
         if key != -1:
             if key == ESC:
                 pause_menu()
@@ -829,116 +3799,333 @@ def main(stdscr):
                 break
             else:
                 # Refresh quest window after pause to remove window overlap
-                update_quest(quest, quest_complete)
+                update_quest(player.quest, player.quest_complete)
 
             # Move Left
             if key == c.KEY_LEFT or key == ord("a") or key == ord("A"):
                 # Set previous player position to open space
-                pad.addstr(y + 12, x + 40, " ")
+                view.addstr(player.y + 12, player.x + 40, " ")
                 # Detect if tile is wall/bear/goldilocks/bear adjacent
                 # (bear emoji character width == 2, so need to check 2 tiles)
-                next_tile = map[y + 12][x + 40 - 1]
+                next_tile = map[player.y + 12, player.x + 40 - 1]
                 if next_tile not in [1, 2, 4]:
-                    # Detect if next tile is a rock
+                    # Detect if next tile is a rock, and pick it up
                     if next_tile == 3:
-                        inventory = update_inventory("Rock", inventory)
-                    x -= 1
+                        update_inventory("Rock", player.inventory)
+                        change_tile(map, player.y + 12, player.x + 40 - 1, 0)
+                    player.x -= 1
 
             # Move Right
             if key == c.KEY_RIGHT or key == ord("d") or key == ord("D"):
-                pad.addstr(y + 12, x + 40, " ")
-                next_tile = map[y + 12][x + 40 + 1]
+                view.addstr(player.y + 12, player.x + 40, " ")
+                next_tile = map[player.y + 12, player.x + 40 + 1]
                 if next_tile not in [1, 2, 4]:
                     if next_tile == 3:
-                        inventory = update_inventory("Rock", inventory)
-                    x += 1
+                        update_inventory("Rock", player.inventory)
+                        change_tile(map, player.y + 12, player.x + 40 + 1, 0)
+                    player.x += 1
 
             # Move Up
             if key == c.KEY_UP or key == ord("w") or key == ord("W"):
-                pad.addstr(y + 12, x + 40, " ")
-                next_tile = map[y + 12 - 1][x + 40]
+                view.addstr(player.y + 12, player.x + 40, " ")
+                next_tile = map[player.y + 12 - 1, player.x + 40]
                 if next_tile not in [1, 2, 4]:
                     if next_tile == 3:
-                        inventory = update_inventory("Rock", inventory)
-                    y -= 1
+                        update_inventory("Rock", player.inventory)
+                        change_tile(map, player.y + 12 - 1, player.x + 40, 0)
+                    player.y -= 1
 
             # Move Down
             if key == c.KEY_DOWN or key == ord("s") or key == ord("S"):
-                pad.addstr(y + 12, x + 40, " ")
-                next_tile = map[y + 12 + 1][x + 40]
+                view.addstr(player.y + 12, player.x + 40, " ")
+                next_tile = map[player.y + 12 + 1, player.x + 40]
                 if next_tile not in [1, 2, 4]:
                     if next_tile == 3:
-                        inventory = update_inventory("Rock", inventory)
-                    y += 1
+                        update_inventory("Rock", player.inventory)
+                        change_tile(map, player.y + 12 + 1, player.x + 40, 0)
+                    player.y += 1
 
             # Show inventory
             if key == ord("i") or key == ord("I"):
-                show_inventory(inventory)
+                show_inventory(player.inventory)
                 # run update quest to ensure quest window displays
                 # properly after show_inventory() call
-                update_quest(quest, quest_complete)
+                update_quest(player.quest, player.quest_complete)
                 controls()
 
-            # Hide goldilocks (until quest is active)
-            if not show_goldilocks:
-                pad.addstr(GOLDILOCKS_Y, GOLDILOCKS_X, "  ", c.color_pair(1))
-
-            if not show_porridge:
-                pad.addstr(PORRIDGE_Y, PORRIDGE_X, "  ", c.color_pair(1))
-
             # Spawn goldilocks on quest initiation
-            if (quest and not goldilocks_spawned):
+            if (player.quest and not player.goldilocks_spawned):
 
-                pad.clear()
+                # Only repaint the tiles that were opened up
                 spawn_goldilocks(map)
-                draw_map(pad, map, colors)
+                renderer.flush()
+                paths.update(GOLDILOCKS_Y - 2, GOLDILOCKS_X,
+                             GOLDILOCKS_Y, GOLDILOCKS_X + 1)
+                if fov is not None:
+                    fov.update(GOLDILOCKS_Y - 2, GOLDILOCKS_X,
+                               GOLDILOCKS_Y, GOLDILOCKS_X + 1)
 
                 # Show Goldilocks, and Porridge
-                show_goldilocks = True
-                show_porridge = True
+                renderer.show_sprite(GOLDILOCKS_Y, GOLDILOCKS_X, "👧")
+                renderer.show_sprite(PORRIDGE_Y, PORRIDGE_X, "🥣")
+                player.show_goldilocks = True
+                player.show_porridge = True
+
+                player.goldilocks_spawned = True
 
-                goldilocks_spawned = True
+            # Repaint the tiles that came into or went out of view
+            if fov is not None:
+                renderer.reveal(fov.visible_from(player.y + 12, player.x + 40))
 
             # Update player position
-            pad.addstr(y + 12, x + 40, f"{PLAYER_ICON}")
+            view.addstr(player.y + 12, player.x + 40, f"{PLAYER_ICON}")
 
-            coords(x + 40, y + 12)
-            pad.refresh(y, x, 0, 0, 22, 60)
+            coords(player.x + 40, player.y + 12)
+            renderer.noutrefresh(player.y, player.x)
 
             # Check if player is near bear:
-            if (x + 40 in range(BEAR_X - 2, BEAR_X + 3) and
-                    y + 12 in range(BEAR_Y - 1, BEAR_Y + 2)):
-                if not quest:
+            if (player.x + 40 in range(BEAR_X - 2, BEAR_X + 3) and
+                    player.y + 12 in range(BEAR_Y - 1, BEAR_Y + 2)):
+                if not player.quest:
                     # Interact with bear and add to quest list
 
-                    quest = bear_dialogue()  # set quest to True
-                    update_quest(quest, quest_complete)  # Set quest window
+                    player.quest = bear_dialogue()  # set quest to True
+                    # Set quest window
+                    update_quest(player.quest, player.quest_complete)
                     controls()
 
-                elif inventory["Porridge"] > 0:
+                elif player.inventory["Porridge"] > 0:
                     bear_dialogue_win()
-                    inventory["Porridge"] = 0
-                    quest = False
-                    quest_complete = True
-                    update_quest(quest, quest_complete)
+                    player.inventory["Porridge"] = 0
+                    player.quest = False
+                    player.quest_complete = True
+                    update_quest(player.quest, player.quest_complete)
 
             # Check if player is near Goldilocks
-            if quest and show_goldilocks:
-                if (x + 40 in range(GOLDILOCKS_X - 1, GOLDILOCKS_X + 3) and
-                        y + 12 in range(PORRIDGE_Y - 1, GOLDILOCKS_Y + 2)):
-                    show_goldilocks = False
+            if player.quest and player.show_goldilocks:
+                if (player.x + 40 in range(GOLDILOCKS_X - 1, GOLDILOCKS_X + 3)
+                        and player.y + 12 in range(PORRIDGE_Y - 1,
+                                                   GOLDILOCKS_Y + 2)):
+                    player.show_goldilocks = False
+                    renderer.hide_sprite(GOLDILOCKS_Y, GOLDILOCKS_X)
                     result = goldilocks_dialogue()
                     controls()
                     if not result:  # Game over if player loses to goldilocks
                         print("GAME OVER")
+                        if save is not None and os.path.exists(save):
+                            os.remove(save)  # Start over next time
                         break
 
             # Check if player is on porridge:
-            if x + 40 == PORRIDGE_X and y + 12 == PORRIDGE_Y and show_porridge:
+            if (player.x + 40 == PORRIDGE_X and player.y + 12 == PORRIDGE_Y
+                    and player.show_porridge):
                 # Add porridge to inventory
-                inventory = update_inventory("Porridge", inventory)
+                update_inventory("Porridge", player.inventory)
                 # Hide porridge
-                show_porridge = False
+                player.show_porridge = False
+                renderer.hide_sprite(PORRIDGE_Y, PORRIDGE_X)
 
+            # Show how far away the next quest goal is
+            if player.quest:
+                goal = "porridge" if player.show_porridge else "bear"
+                steps = paths.distance(goal, player.y + 12, player.x + 40)
+                update_quest(player.quest, player.quest_complete, steps)
 
-c.wrapper(main)
+            # Send everything that changed this frame to the terminal at once
+            frame.show()
+            if save is not None:
+                save_game(save, player, infinite)
+            telemetry.record("frame", started)
+
+
+async def serve(path, seed=None, infinite=False, fog=False):
+    """
+    Game server: hosts any number of players in this one process. Each
+    connection to the unix socket at path plays its own session, with its
+    own player, inventory, quests and screen, on a game thread of its own.
+    Every session plays the same world: one read-only copy of the map
+    (or one ChunkManager for an endless world), with each session's
+    changes in its own MapOverlay
+    Args:
+        path (str): Socket file path
+        seed (int): World seed, a random seed is used if None
+        infinite (bool): Endless chunk generated world
+        fog (bool): Fog of war
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    world = prepare_map(True, seed) if infinite else shared_map(seed)
+    loop = asyncio.get_running_loop()
+    players = 0
+
+    def play(terminal, finished):
+        use_backend(terminal)
+        try:
+            if isinstance(world, MapOverlay):
+                map = MapOverlay(world.base)
+            elif isinstance(world, ChunkManager):
+                map = MapOverlay(world)
+            else:
+                map = prepare_map(infinite, seed)
+            terminal.wrapper(main, infinite=infinite, seed=seed, map=map,
+                             fog=fog)
+        except EndOfInput:
+            pass
+        finally:
+            use_backend(None)
+            loop.call_soon_threadsafe(finished.set_result, None)
+
+    async def connect(reader, writer):
+        nonlocal players
+        terminal = SocketTerminal(loop, writer)
+        finished = loop.create_future()
+        threading.Thread(target=play, args=(terminal, finished),
+                         daemon=True).start()
+        players += 1
+        print(f"Player joined, {players} playing")
+        try:
+            while not finished.done():
+                reading = asyncio.ensure_future(reader.read(1024))
+                await asyncio.wait((reading, finished),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not reading.done():
+                    reading.cancel()
+                    break
+                data = reading.result()
+                if not data:
+                    break
+                terminal.feed(data)
+        except ConnectionError:
+            pass
+        terminal.close()
+        await finished
+        players -= 1
+        print(f"Player left, {players} playing")
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    if sys.platform == "win32":
+        raise SystemExit("--serve needs Unix sockets, Windows doesn't have "
+                         "them")
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(connect, path)
+    print(f"Serving seed {seed} on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+@contextlib.contextmanager
+def no_echo(stream):
+    """
+    Turns off echo on a terminal while in the with block, so a line sent
+    to a warm worker (the player's save file) isn't shown to the player
+    before the game starts. Does nothing if stream isn't a terminal
+    Args:
+        stream (file): Input stream, e.g. sys.stdin
+    """
+    if sys.platform == "win32" or not stream.isatty():
+        yield
+        return
+    import termios
+    fd = stream.fileno()
+    saved = termios.tcgetattr(fd)
+    quiet = termios.tcgetattr(fd)
+    quiet[3] &= ~termios.ECHO  # Local modes
+    termios.tcsetattr(fd, termios.TCSANOW, quiet)
+    try:
+        yield
+    finally:
+        termios.tcsetattr(fd, termios.TCSANOW, saved)
+
+
+def cli(argv=None):
+    """
+    Runs the game, or the map pool, game server or replays, from the
+    command line
+    Args:
+        argv (list): Command line arguments, sys.argv[1:] if None
+    """
+    parser = argparse.ArgumentParser(description="Tiny Adventure")
+    parser.add_argument("--infinite", action="store_true",
+                        help="explore an endless, chunk generated world")
+    parser.add_argument("--seed", type=int,
+                        help="world seed, the same seed gives the same map")
+    parser.add_argument("--shared", action="store_true",
+                        help="with --seed, play the map read-only from the "
+                        "map cache, shared with every other game on it")
+    parser.add_argument("--daily", action="store_true",
+                        help="play today's map, shared with every game "
+                        "played today")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the game to FILE after every move, and "
+                        "resume it from FILE if it's there")
+    parser.add_argument("--fog", action="store_true",
+                        help="fog of war, only show what the player can "
+                        "see")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="record generation, frame and fight tick "
+                        "timings and write them to FILE as JSON on exit")
+    parser.add_argument("--pstats", metavar="FILE",
+                        help="with --profile, also write cProfile stats "
+                        "to FILE (under --serve, of the event loop only)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="don't play, replay the keys in a JSON key "
+                        "script without a terminal and time it")
+    parser.add_argument("--sessions", type=int, default=1, metavar="N",
+                        help="number of games to replay (with --replay)")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="don't play, host games for any number of "
+                        "players connecting to a unix socket")
+    parser.add_argument("--map-pool", type=int, metavar="N",
+                        help="don't play, keep N ready-to-play maps in "
+                        "the map pool instead")
+    parser.add_argument("--workers", type=int, default=SMOOTH_WORKERS,
+                        metavar="N",
+                        help="with --map-pool, smooth maps of "
+                        "PARALLEL_SMOOTH_TILES or more in N processes "
+                        "(default SMOOTH_WORKERS or the CPU count)")
+    parser.add_argument("--warm", action="store_true",
+                        help="get the map ready, then wait for a newline "
+                        "on stdin before starting the game")
+    args = parser.parse_args(argv)
+    if args.daily:
+        args.seed = daily_seed()
+        args.shared = True
+
+    if args.profile:
+        telemetry.enable(args.profile, args.pstats)
+
+    if args.map_pool is not None:
+        run_map_pool(args.map_pool, workers=args.workers)
+    elif args.serve is not None:
+        try:
+            asyncio.run(serve(args.serve, args.seed, args.infinite,
+                              args.fog))
+        except KeyboardInterrupt:
+            pass
+    elif args.replay is not None:
+        run_replays(args.replay, args.sessions, args.seed, args.infinite,
+                    args.fog)
+    elif args.warm:
+        # Warm worker: the web server keeps a few of these parked on a
+        # pty and sends a newline when a player connects. The line can
+        # hold the player's save file, to resume their game
+        with no_echo(sys.stdin):
+            map = prepare_map(args.infinite, args.seed, args.shared)
+            line = sys.stdin.readline()
+        if line:
+            c.wrapper(main, infinite=args.infinite, seed=args.seed, map=map,
+                      fog=args.fog, shared=args.shared,
+                      save=line.strip() or args.save)
+    else:
+        c.wrapper(main, infinite=args.infinite, seed=args.seed, fog=args.fog,
+                  shared=args.shared, save=args.save)
+
+
+if __name__ == "__main__":
+    cli()